@@ -1,16 +1,34 @@
 """Agent - LLM 调用和工具执行"""
+import asyncio
 import json
 import os
-import subprocess
+import re
+import signal
+import time
+from collections import OrderedDict
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Callable, Awaitable, Tuple
 from litellm import acompletion
 from loguru import logger
 
+from router import ModelRouter
+
+
+class MaxIterationsReached(RuntimeError):
+    """达到最大迭代次数仍没有最终响应（仅在 raise_errors=True 时抛出）"""
+
 
 class Agent:
     """极简 AI Agent，支持工具调用"""
 
+    # 只读工具：结果按路径 + mtime/size 缓存，重复内容以引用代替
+    READ_ONLY_TOOLS = ("read_file", "list_dir")
+    # 短于该长度的结果不做去重（引用本身也要占上下文）
+    DEDUP_MIN_LENGTH = 200
+    # 去重引用的格式，压缩时据此识别被引用的结果
+    DEDUP_REFERENCE = "（内容与之前的工具结果 {id} 相同，自上次读取后未变化，请直接参考该结果）"
+    DEDUP_REFERENCE_PATTERN = re.compile(r"^（内容与之前的工具结果 (\S+) 相同")
+
     def __init__(
         self,
         model: str,
@@ -18,7 +36,14 @@ class Agent:
         max_iterations: int = 10,
         shell_timeout: int = 30,
         api_base: Optional[str] = None,
-        user_agent: Optional[str] = None
+        user_agent: Optional[str] = None,
+        context_token_limit: int = 12000,
+        keep_recent_tool_results: int = 2,
+        compacted_result_length: int = 300,
+        tool_cache_size: int = 256,
+        router: Optional[ModelRouter] = None,
+        llm_extra_kwargs: Optional[Dict[str, Any]] = None,
+        raise_errors: bool = False
     ):
         self.model = model
         self.workspace = workspace
@@ -26,67 +51,104 @@ class Agent:
         self.shell_timeout = shell_timeout
         self.api_base = api_base
         self.user_agent = user_agent
+        self.context_token_limit = context_token_limit
+        self.keep_recent_tool_results = keep_recent_tool_results
+        self.compacted_result_length = compacted_result_length
+        self.tool_cache_size = tool_cache_size
+        self.router = router
+        self.llm_extra_kwargs = llm_extra_kwargs or {}  # 额外的 LiteLLM 参数（如 mock_response）
+        # 出错或达到最大迭代次数时抛出异常，而不是返回提示文本（批处理用于区分失败）
+        self.raise_errors = raise_errors
+        # (工具名, 解析后的路径) -> ((mtime_ns, size), 结果)
+        self._tool_cache: "OrderedDict[Tuple[str, Path], Tuple[Tuple[int, int], str]]" = OrderedDict()
 
+        self.model = self._resolve_model(model)
+        logger.info(f"Agent initialized: model={self.model}, workspace={workspace}, api_base={api_base}, user_agent={user_agent}")
+    
+    def _resolve_model(self, model: str) -> str:
+        """补全模型名的 provider 前缀"""
         # 检测是否使用自定义 API 端点
         # 参考 nanobot 的实现
-        if api_base:
+        if self.api_base:
             # 对于使用 OpenAI 兼容接口的自定义端点
             # 使用 openai/ 前缀，这样 LiteLLM 会调用 OpenAI 兼容的路径
             if not any(prefix in model for prefix in ["openai/", "anthropic/", "openrouter/", "gemini/", "zhipu/", "zai/", "groq/", "hosted_vllm/"]):
-                self.model = f"openai/{model}"
-        logger.info(f"Agent initialized: model={self.model}, workspace={workspace}, api_base={api_base}, user_agent={user_agent}")
+                return f"openai/{model}"
+        return model
     
-    async def process(self, user_message: str, history: List[Dict[str, Any]]) -> str:
+    async def process(
+        self,
+        user_message: str,
+        history: List[Dict[str, Any]],
+        checkpoint: Optional[Callable[[List[Dict[str, Any]]], Awaitable[None]]] = None,
+        resume: Optional[List[Dict[str, Any]]] = None,
+        usage: Optional[Dict[str, float]] = None
+    ) -> str:
         """
         处理用户消息，返回响应
         
         Args:
             user_message: 用户消息
             history: 历史对话（OpenAI 格式的 messages）
+            checkpoint: 每完成一轮工具调用后回调，参数为本轮至今的完整轨迹
+                （assistant tool_calls + tool 结果）
+            resume: 之前中断时保存的轨迹，从最后完成的迭代继续
+            usage: 用量累加器，写入 prompt_tokens / completion_tokens / tool_time（秒）
         
         Returns:
             Agent 的响应文本
+        
+        Raises:
+            MaxIterationsReached / 迭代中的异常：仅在 raise_errors=True 时抛出
         """
+        # 本轮的工具调用轨迹（不受上下文压缩影响）
+        trace = list(resume or [])
+        
+        # 用量统计
+        if usage is None:
+            usage = {}
+        for key in ("prompt_tokens", "completion_tokens", "tool_time"):
+            usage.setdefault(key, 0)
+        
         # 构建 messages
         messages = [
             {"role": "system", "content": self._get_system_prompt()},
             *history,  # 历史对话
-            {"role": "user", "content": user_message}
+            {"role": "user", "content": user_message},
+            *trace  # 恢复的轨迹
         ]
+        # 本轮轨迹（含恢复的部分）的起始位置
+        turn_start = len(messages) - len(trace)
         
         # 工具定义
         tools = self._get_tools()
         
+        # 已完成的迭代数（恢复时跳过）
+        completed = sum(1 for m in trace if m["role"] == "assistant")
+        if completed:
+            logger.info(f"Resuming turn after {completed} completed iterations")
+        
         # 迭代调用（支持多次工具调用，类似 ReAct）
-        for iteration in range(1, self.max_iterations + 1):
+        for iteration in range(completed + 1, self.max_iterations + 1):
             logger.debug(f"Iteration {iteration}/{self.max_iterations}")
             
             try:
-                # 构建 LLM 调用参数
-                llm_kwargs = {
-                    "model": self.model,
-                    "messages": messages,
-                    "tools": tools,
-                    "tool_choice": "auto"
-                }
+                # 上下文过长时压缩较早的工具结果
+                self._compact_tool_results(messages)
 
-                # 添加自定义 API base URL
-                if self.api_base:
-                    llm_kwargs["api_base"] = self.api_base
-                    api_key = os.getenv("API_KEY")
-                    if not api_key:
-                        raise ValueError("API_KEY 环境变量未设置")
-                    llm_kwargs["api_key"] = api_key
-
-                # 添加自定义 User-Agent
-                if self.user_agent:
-                    llm_kwargs["extra_headers"] = {"User-Agent": self.user_agent}
+                # 选择模型（未配置路由时始终使用 self.model）
+                model = self.router.select(user_message, iteration) if self.router else self.model
 
                 # 调用 LLM
-                response = await acompletion(**llm_kwargs)
-                
+                response = await self._call_llm(model, messages, tools, usage)
                 msg = response.choices[0].message
                 
+                # 快速模型低置信度或需要工具时，交给强模型重做本次迭代
+                if self.router and self.router.should_escalate(model, msg, response.choices[0].finish_reason):
+                    logger.info(f"Escalating iteration {iteration}: {model} -> {self.router.strong_model}")
+                    response = await self._call_llm(self.router.strong_model, messages, tools, usage)
+                    msg = response.choices[0].message
+                
                 # 没有工具调用，返回最终响应
                 if not msg.tool_calls:
                     final_response = msg.content or "（无响应内容）"
@@ -97,7 +159,7 @@ class Agent:
                 logger.info(f"Tool calls: {[tc.function.name for tc in msg.tool_calls]}")
                 
                 # 添加 assistant 消息（包含 tool_calls）
-                messages.append({
+                assistant_msg = {
                     "role": "assistant",
                     "content": msg.content or "",
                     "tool_calls": [
@@ -111,7 +173,9 @@ class Agent:
                         }
                         for tc in msg.tool_calls
                     ]
-                })
+                }
+                messages.append(assistant_msg)
+                trace.append(assistant_msg)
                 
                 # 执行每个工具
                 for tool_call in msg.tool_calls:
@@ -133,33 +197,200 @@ class Agent:
                             logger.info("使用 ast.literal_eval 成功解析参数")
                         except:
                             # 如果还是失败，返回错误信息
-                            messages.append({
+                            tool_msg = {
                                 "role": "tool",
                                 "tool_call_id": tool_call.id,
                                 "content": f"❌ 参数解析失败: {error_msg}\n\n提示：请确保字符串中的特殊字符正确转义（如 \\ 应写作 \\\\）"
-                            })
+                            }
+                            messages.append(tool_msg)
+                            trace.append(tool_msg)
                             continue
 
                     logger.debug(f"Executing: {tool_name}({tool_args})")
-                    result = self._execute_tool(tool_name, tool_args)
+                    tool_start = time.monotonic()
+                    result = await self._execute_tool(tool_name, tool_args)
+                    usage["tool_time"] += time.monotonic() - tool_start
+                    if tool_name in self.READ_ONLY_TOOLS:
+                        result = self._dedup_tool_result(messages, result, turn_start)
                     
                     # 添加工具结果
-                    messages.append({
+                    tool_msg = {
                         "role": "tool",
                         "tool_call_id": tool_call.id,
                         "content": result
-                    })
+                    }
+                    messages.append(tool_msg)
+                    trace.append(tool_msg)
                     
                     logger.debug(f"Tool result: {result[:200]}...")
+                
+                # 保存检查点（本次迭代已完成）
+                if checkpoint:
+                    await checkpoint(list(trace))
             
             except Exception as e:
                 logger.error(f"Error in iteration {iteration}: {e}")
+                if self.raise_errors:
+                    raise
                 return f"处理消息时出错：{str(e)}"
         
         # 达到最大迭代次数
         logger.warning("Reached max iterations")
+        if self.raise_errors:
+            raise MaxIterationsReached(f"达到最大处理轮次（{self.max_iterations}），任务可能未完成")
         return "达到最大处理轮次，任务可能未完成。"
     
+    async def _call_llm(
+        self,
+        model: str,
+        messages: List[Dict[str, Any]],
+        tools: List[Dict[str, Any]],
+        usage: Dict[str, float]
+    ):
+        """调用 LLM，累加 token 用量并向路由器报告延迟"""
+        # 构建 LLM 调用参数
+        llm_kwargs = {
+            "model": self._resolve_model(model),
+            "messages": messages,
+            "tools": tools,
+            "tool_choice": "auto"
+        }
+
+        # 添加自定义 API base URL
+        if self.api_base:
+            llm_kwargs["api_base"] = self.api_base
+            api_key = os.getenv("API_KEY")
+            if not api_key:
+                raise ValueError("API_KEY 环境变量未设置")
+            llm_kwargs["api_key"] = api_key
+
+        # 添加自定义 User-Agent
+        if self.user_agent:
+            llm_kwargs["extra_headers"] = {"User-Agent": self.user_agent}
+
+        llm_kwargs.update(self.llm_extra_kwargs)
+
+        start = time.monotonic()
+        response = await acompletion(**llm_kwargs)
+        if self.router:
+            self.router.record(model, time.monotonic() - start)
+        
+        response_usage = getattr(response, "usage", None)
+        if response_usage:
+            usage["prompt_tokens"] += response_usage.prompt_tokens or 0
+            usage["completion_tokens"] += response_usage.completion_tokens or 0
+        return response
+    
+    def _dedup_tool_result(self, messages: List[Dict[str, Any]], result: str, turn_start: int = 0) -> str:
+        """
+        如果相同的只读工具结果仍完整保留在本轮上下文中，返回对它的引用而不是重复内容
+        
+        只引用本轮的结果：引用会随轨迹保存到历史，而之后的轮次不一定带着被引用的结果。
+        
+        Args:
+            messages: 当前消息缓冲区（含历史）
+            result: 本次工具结果
+            turn_start: 本轮轨迹在 messages 中的起始位置
+        """
+        if len(result) < self.DEDUP_MIN_LENGTH:
+            return result
+        for m in reversed(messages[turn_start:]):
+            if m["role"] == "tool" and m["content"] == result:
+                logger.debug(f"Tool result unchanged since {m['tool_call_id']}, returning reference")
+                return self.DEDUP_REFERENCE.format(id=m["tool_call_id"])
+        return result
+    
+    def _cached_read(self, name: str, path: Path, read: Callable[[], str]) -> str:
+        """
+        读取只读工具结果，按 (路径, mtime, size) 缓存
+        
+        Args:
+            name: 工具名称
+            path: 目标路径
+            read: 缓存未命中时生成结果的函数
+        """
+        key = (name, path.resolve())
+        st = path.stat()
+        stamp = (st.st_mtime_ns, st.st_size)
+        
+        cached = self._tool_cache.get(key)
+        if cached and cached[0] == stamp:
+            self._tool_cache.move_to_end(key)
+            return cached[1]
+        
+        result = read()
+        self._tool_cache[key] = (stamp, result)
+        self._tool_cache.move_to_end(key)
+        while len(self._tool_cache) > self.tool_cache_size:
+            self._tool_cache.popitem(last=False)
+        return result
+    
+    def _invalidate_cache(self, path: Path):
+        """写入文件后使其读取缓存和所在目录的列表缓存失效"""
+        resolved = path.resolve()
+        self._tool_cache.pop(("read_file", resolved), None)
+        self._tool_cache.pop(("list_dir", resolved.parent), None)
+    
+    @staticmethod
+    def _estimate_tokens(messages: List[Dict[str, Any]]) -> int:
+        """粗略估算 messages 的 token 数（约 4 字符 / token）"""
+        chars = 0
+        for m in messages:
+            chars += len(m.get("content") or "")
+            for tc in m.get("tool_calls") or []:
+                chars += len(tc["function"]["arguments"] or "")
+        return chars // 4
+    
+    def _compact_tool_results(self, messages: List[Dict[str, Any]]):
+        """
+        压缩较早的工具结果（原地替换列表元素，不修改原消息对象）
+        
+        超过 context_token_limit 时，把除最近 keep_recent_tool_results 条以外的
+        工具结果替换为截断后的摘要，避免过期输出在每次迭代中被重复发送。
+        历史中保存的工具结果最先被压缩。去重引用不计入最近窗口，
+        被引用的结果不会被压缩（否则引用会指向已不在上下文中的内容）。
+        
+        Args:
+            messages: 当前消息缓冲区
+        """
+        if self._estimate_tokens(messages) <= self.context_token_limit:
+            return
+        
+        referenced = set()
+        tool_indices = []
+        for i, m in enumerate(messages):
+            if m["role"] != "tool":
+                continue
+            match = self.DEDUP_REFERENCE_PATTERN.match(m["content"])
+            if match:
+                referenced.add(match.group(1))
+            else:
+                tool_indices.append(i)
+        if self.keep_recent_tool_results > 0:
+            tool_indices = tool_indices[:-self.keep_recent_tool_results]
+        
+        compacted = 0
+        for i in tool_indices:
+            content = messages[i]["content"]
+            if messages[i]["tool_call_id"] in referenced:
+                continue
+            if content.startswith("[已压缩]") or len(content) <= self.compacted_result_length:
+                continue
+            messages[i] = {
+                **messages[i],
+                "content": (
+                    f"[已压缩] 较早的工具结果（原 {len(content)} 字符），仅保留开头：\n"
+                    f"{content[:self.compacted_result_length]}…\n"
+                    f"（如需完整内容请重新调用工具）"
+                )
+            }
+            compacted += 1
+            if self._estimate_tokens(messages) <= self.context_token_limit:
+                break
+        
+        if compacted:
+            logger.debug(f"Compacted {compacted} tool results, ~{self._estimate_tokens(messages)} tokens left")
+    
     def _get_system_prompt(self) -> str:
         """系统提示词"""
         return f"""你是一个有用的 AI 助手，可以使用工具完成任务。
@@ -261,7 +492,7 @@ class Agent:
             }
         ]
     
-    def _execute_tool(self, name: str, args: Dict[str, Any]) -> str:
+    async def _execute_tool(self, name: str, args: Dict[str, Any]) -> str:
         """
         执行工具
         
@@ -279,14 +510,18 @@ class Agent:
                     return f"错误：文件不存在 {path}"
                 if not path.is_file():
                     return f"错误：{path} 不是文件"
-                content = path.read_text(encoding="utf-8")
-                return f"文件内容（{len(content)} 字符）：\n{content}"
+                
+                def read():
+                    content = path.read_text(encoding="utf-8")
+                    return f"文件内容（{len(content)} 字符）：\n{content}"
+                return self._cached_read(name, path, read)
             
             elif name == "write_file":
                 path = self.workspace / args["path"]
                 # 创建父目录
                 path.parent.mkdir(parents=True, exist_ok=True)
                 path.write_text(args["content"], encoding="utf-8")
+                self._invalidate_cache(path)
                 return f"✅ 已写入文件：{path.relative_to(self.workspace)}"
             
             elif name == "list_dir":
@@ -296,15 +531,17 @@ class Agent:
                 if not dir_path.is_dir():
                     return f"错误：{dir_path} 不是目录"
                 
-                items = []
-                for item in sorted(dir_path.iterdir()):
-                    item_type = "📁" if item.is_dir() else "📄"
-                    rel_path = item.relative_to(self.workspace)
-                    items.append(f"{item_type} {rel_path}")
-                
-                if not items:
-                    return "目录为空"
-                return "目录内容：\n" + "\n".join(items)
+                def read():
+                    items = []
+                    for item in sorted(dir_path.iterdir()):
+                        item_type = "📁" if item.is_dir() else "📄"
+                        rel_path = item.relative_to(self.workspace)
+                        items.append(f"{item_type} {rel_path}")
+                    
+                    if not items:
+                        return "目录为空"
+                    return "目录内容：\n" + "\n".join(items)
+                return self._cached_read(name, dir_path, read)
             
             elif name == "exec_shell":
                 command = args["command"]
@@ -315,26 +552,49 @@ class Agent:
                     return f"🚫 拒绝执行危险命令：{command}"
                 
                 logger.info(f"Executing shell: {command}")
-                result = subprocess.run(
-                    command,
-                    shell=True,
-                    cwd=self.workspace,
-                    capture_output=True,
-                    text=True,
-                    timeout=self.shell_timeout
-                )
-                
-                output = result.stdout if result.stdout else result.stderr
-                if not output:
-                    output = f"命令执行完成（退出码：{result.returncode}）"
-                
-                return f"Shell 输出：\n{output}"
+                return await self._exec_shell(command)
             
             else:
                 return f"❌ 未知工具：{name}"
         
-        except subprocess.TimeoutExpired:
-            return f"❌ 命令执行超时（{self.shell_timeout}秒）"
         except Exception as e:
             logger.error(f"Tool execution error: {e}")
             return f"❌ 工具执行失败：{str(e)}"
+    
+    async def _exec_shell(self, command: str) -> str:
+        """
+        异步执行 shell 命令
+        
+        超时或所在任务被取消时，会终止整个进程组（包括 shell 启动的子进程）。
+        """
+        proc = await asyncio.create_subprocess_shell(
+            command,
+            cwd=self.workspace,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=self.shell_timeout)
+        except asyncio.TimeoutError:
+            await self._kill_process(proc)
+            return f"❌ 命令执行超时（{self.shell_timeout}秒）"
+        except asyncio.CancelledError:
+            logger.info(f"Shell command cancelled, killing pid {proc.pid}")
+            await self._kill_process(proc)
+            raise
+        
+        output = stdout.decode("utf-8", errors="replace") or stderr.decode("utf-8", errors="replace")
+        if not output:
+            output = f"命令执行完成（退出码：{proc.returncode}）"
+        
+        return f"Shell 输出：\n{output}"
+    
+    @staticmethod
+    async def _kill_process(proc: asyncio.subprocess.Process):
+        """终止子进程所在的进程组并回收"""
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await proc.wait()
@@ -0,0 +1,217 @@
+"""Batch - 无界面批量运行 Agent（评测 / 批处理）
+
+用法：
+    python batch.py prompts.jsonl -o results.jsonl -c 8
+
+输入每行一个 JSON：{"id": "可选，默认行号", "prompt": "用户消息"}
+输出每行一个 JSON：{"id", "response", "error", "elapsed", "tool_calls"}
+结果逐条追加写入；重新运行同一命令会跳过输出文件中已成功的条目，出错的条目会重跑。
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, Set
+from dotenv import load_dotenv
+from loguru import logger
+
+from agent import Agent
+
+
+BASE_DIR = Path(__file__).parent
+
+# 工作目录名中允许保留的字符
+UNSAFE_CHARS = re.compile(r"[^\w.-]")
+
+
+def iter_prompts(path: Path) -> Iterator[Dict[str, Any]]:
+    """逐行读取输入 JSONL（不一次性载入内存）"""
+    with path.open(encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            item.setdefault("id", str(line_no))
+            item["id"] = str(item["id"])
+            yield item
+
+
+def load_done_ids(path: Path) -> Set[str]:
+    """读取已成功完成的条目 ID（用于断点续跑，出错的条目不计入）"""
+    done = set()
+    if not path.exists():
+        return done
+    with path.open(encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+                if not result.get("error"):
+                    done.add(str(result["id"]))
+            except (json.JSONDecodeError, KeyError):
+                # 中断时可能留下半行，忽略
+                continue
+    return done
+
+
+def workspace_name(item_id: str) -> str:
+    """
+    条目 ID 对应的工作目录名
+
+    ID 可能包含 "/"、".." 等字符，替换后附加 ID 的哈希，保证不越界且不同 ID 不会冲突。
+    """
+    digest = hashlib.md5(item_id.encode("utf-8")).hexdigest()[:8]
+    return f"{UNSAFE_CHARS.sub('_', item_id)[:48]}-{digest}"
+
+
+class BatchRunner:
+    """以有限并发在独立工作目录中运行 Agent"""
+
+    def __init__(
+        self,
+        agent_kwargs: Dict[str, Any],
+        workspace_root: Path,
+        concurrency: int = 4,
+        timeout: Optional[float] = None
+    ):
+        self.agent_kwargs = agent_kwargs
+        self.workspace_root = workspace_root
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+    async def run_item(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        """在该条目的独立工作目录中运行一次 Agent"""
+        workspace = self.workspace_root / workspace_name(item["id"])
+        # 重跑时清掉上次中断或出错留下的文件
+        await asyncio.to_thread(shutil.rmtree, workspace, ignore_errors=True)
+        workspace.mkdir(parents=True, exist_ok=True)
+        # 出错和达到最大迭代次数都以异常返回，记录到 error 中，续跑时重试
+        agent = Agent(workspace=workspace, raise_errors=True, **self.agent_kwargs)
+
+        trace = []
+
+        async def checkpoint(new_trace: list):
+            trace[:] = new_trace
+
+        result = {"id": item["id"], "response": None, "error": None}
+        start = time.monotonic()
+        try:
+            result["response"] = await asyncio.wait_for(
+                agent.process(item["prompt"], item.get("history", []), checkpoint=checkpoint),
+                timeout=self.timeout
+            )
+        except asyncio.TimeoutError:
+            result["error"] = f"超时（{self.timeout}秒）"
+        except Exception as e:
+            result["error"] = str(e)
+        result["elapsed"] = round(time.monotonic() - start, 3)
+        result["tool_calls"] = sum(1 for m in trace if m["role"] == "tool")
+        return result
+
+    async def run(self, input_path: Path, output_path: Path) -> Dict[str, Any]:
+        """
+        运行整个批次
+
+        Returns:
+            统计信息（完成数、跳过数、错误数、总耗时）
+        """
+        done = load_done_ids(output_path)
+        if done:
+            logger.info(f"Resuming: {len(done)} items already done")
+
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        stats = {"completed": 0, "skipped": 0, "errors": 0}
+        queued: Set[str] = set()
+        start = time.monotonic()
+
+        # 中断时可能留下不完整的最后一行，先补换行，避免与新结果粘连
+        if output_path.exists() and output_path.stat().st_size:
+            with output_path.open("rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    with output_path.open("a", encoding="utf-8") as out:
+                        out.write("\n")
+
+        with output_path.open("a", encoding="utf-8") as out:
+
+            async def worker():
+                while True:
+                    item = await queue.get()
+                    if item is None:
+                        return
+                    result = await self.run_item(item)
+                    out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    out.flush()
+                    stats["completed"] += 1
+                    if result["error"]:
+                        stats["errors"] += 1
+                    logger.info(f"[{stats['completed']}] {item['id']} done in {result['elapsed']}s")
+
+            workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+            try:
+                for item in iter_prompts(input_path):
+                    if item["id"] in done:
+                        stats["skipped"] += 1
+                        continue
+                    # 重复的 ID 只运行第一条
+                    if item["id"] in queued:
+                        logger.warning(f"Duplicate id {item['id']}, skipped")
+                        stats["skipped"] += 1
+                        continue
+                    queued.add(item["id"])
+                    await queue.put(item)
+                for _ in workers:
+                    await queue.put(None)
+                await asyncio.gather(*workers)
+            finally:
+                for w in workers:
+                    w.cancel()
+
+        stats["elapsed"] = round(time.monotonic() - start, 3)
+        if stats["completed"]:
+            stats["throughput"] = round(stats["completed"] / stats["elapsed"], 2)
+        return stats
+
+
+def main():
+    """命令行入口"""
+    load_dotenv(BASE_DIR / ".env")
+
+    parser = argparse.ArgumentParser(description="批量运行 MiniClaw Agent")
+    parser.add_argument("input", type=Path, help="输入 JSONL（每行 {id, prompt}）")
+    parser.add_argument("-o", "--output", type=Path, required=True, help="输出 JSONL（逐条追加，可断点续跑）")
+    parser.add_argument("-c", "--concurrency", type=int, default=4, help="并发数（默认 4）")
+    parser.add_argument("--workspace-root", type=Path, default=BASE_DIR / "workspace" / "batch",
+                        help="每个条目的独立工作目录的父目录")
+    parser.add_argument("--max-iterations", type=int, default=10, help="每条最大工具调用轮次")
+    parser.add_argument("--timeout", type=float, default=None, help="每条超时（秒）")
+    parser.add_argument("--mock-response", default=None,
+                        help="使用 LiteLLM 内置 mock，不请求真实 API（吞吐测试）")
+    parser.add_argument("--mock-delay", type=float, default=0.0, help="mock 响应延迟（秒）")
+    args = parser.parse_args()
+
+    agent_kwargs = {
+        "model": os.getenv("LLM_MODEL", "gpt-4o-mini"),
+        "max_iterations": args.max_iterations,
+        "api_base": os.getenv("BASE_URL"),
+        "user_agent": os.getenv("CUSTOM_USER_AGENT"),
+    }
+    if args.mock_response is not None:
+        agent_kwargs["api_base"] = None
+        agent_kwargs["llm_extra_kwargs"] = {
+            "mock_response": args.mock_response,
+            "mock_delay": args.mock_delay,
+        }
+
+    runner = BatchRunner(agent_kwargs, args.workspace_root, args.concurrency, args.timeout)
+    stats = asyncio.run(runner.run(args.input, args.output))
+    logger.info(f"Batch finished: {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,20 @@
 """Telegram Bot - 消息监听和路由"""
-import json
+import io
 import asyncio
+import signal
+import time
 from pathlib import Path
-from telegram import Update
+from typing import Dict, List, Optional
+from telegram import Update, Bot
 from telegram.ext import Application, MessageHandler, CommandHandler, filters, ContextTypes
 from loguru import logger
 
 from agent import Agent
+from diagnostics import LoopWatchdog, SamplingProfiler
+from memory import MemoryIndex, load_embedder, summarize_history
+from router import ModelRouter
+from session import KeyedLock, SessionStore
+from usage import UsageTracker
 import config
 
 
@@ -14,44 +22,199 @@ class TelegramBot:
     """Telegram Bot 封装"""
     
     def __init__(self):
+        self.router = ModelRouter(config.FAST_MODEL, config.LLM_MODEL) if config.FAST_MODEL else None
         self.agent = Agent(
             model=config.LLM_MODEL,
             workspace=config.WORKSPACE,
             max_iterations=config.MAX_ITERATIONS,
             shell_timeout=config.SHELL_TIMEOUT,
             api_base=config.BASE_URL,
-            user_agent=config.CUSTOM_USER_AGENT
+            user_agent=config.CUSTOM_USER_AGENT,
+            context_token_limit=config.CONTEXT_TOKEN_LIMIT,
+            keep_recent_tool_results=config.KEEP_RECENT_TOOL_RESULTS,
+            router=self.router
         )
+        self.sessions = SessionStore(
+            config.SESSION_DIR,
+            fsync=config.SESSION_FSYNC,
+            encoding=config.SESSION_ENCODING
+        )
+        self.usage = UsageTracker(
+            config.SESSION_DIR / "usage.jsonl",
+            chat_tokens_per_minute=config.CHAT_TOKENS_PER_MINUTE,
+            chat_tokens_per_day=config.CHAT_TOKENS_PER_DAY,
+            global_tokens_per_minute=config.GLOBAL_TOKENS_PER_MINUTE,
+            global_tokens_per_day=config.GLOBAL_TOKENS_PER_DAY
+        )
+        self.memory = MemoryIndex(
+            config.SESSION_DIR / "memory",
+            embed_fn=load_embedder(config.RETRIEVAL_EMBEDDER),
+            top_k=config.RETRIEVAL_TOP_K,
+            recent_turns=config.RETRIEVAL_RECENT_TURNS
+        ) if config.RETRIEVAL_ENABLED else None
+        self.profiler = SamplingProfiler()
+        # 每个会话进行中的轮次（可取消）及串行化锁
+        self._turns: Dict[int, asyncio.Task] = {}
+        self._chat_locks = KeyedLock()
         logger.info("TelegramBot initialized")
     
-    def _get_session_file(self, chat_id: int) -> Path:
-        """获取会话文件路径"""
-        return config.SESSION_DIR / f"{chat_id}.json"
+    async def _run_turn(self, chat_id: int, user_text: str, resume: Optional[list] = None) -> str:
+        """
+        执行一轮对话，逐次迭代保存检查点，完成后把完整轨迹写入历史
+        
+        Args:
+            chat_id: 会话 ID
+            user_text: 用户消息
+            resume: 中断前保存的工具调用轨迹（用于恢复）
+        
+        Returns:
+            Agent 的响应文本
+        """
+        history = await self.sessions.load_history(chat_id)
+        trace = list(resume or [])
+        await self.sessions.save_pending(chat_id, user_text, trace)
+        
+        async def checkpoint(new_trace: list):
+            trace[:] = new_trace
+            await self.sessions.save_pending(chat_id, user_text, new_trace)
+        
+        # 启用检索记忆时只注入相关的早期轮次 + 最近窗口
+        context = history
+        if self.memory:
+            context = await asyncio.to_thread(self.memory.select_history, chat_id, history, user_text)
+        # 工具调用轨迹只保存在会话文件中（用于恢复和检索），不回放给模型
+        context = summarize_history(context)
+        
+        usage = {}
+        try:
+            response = await self.agent.process(
+                user_text, context, checkpoint=checkpoint, resume=resume, usage=usage
+            )
+        except asyncio.CancelledError:
+            # 记录已完成的部分轨迹，取消的轮次不再恢复
+            logger.info(f"Turn cancelled for {chat_id} after {len(trace)} trace messages")
+            await self._finish_turn(chat_id, history, user_text, trace, "（任务已取消）")
+            raise
+        finally:
+            self.usage.record(chat_id, usage)
+        
+        # 响应已生成，此后晚到的取消不再丢弃它
+        if await self._finish_turn(chat_id, history, user_text, trace, response):
+            logger.info(f"Cancel for {chat_id} arrived after the turn completed, ignored")
+        return response
     
-    def _load_history(self, chat_id: int) -> list:
-        """加载会话历史"""
-        session_file = self._get_session_file(chat_id)
-        if session_file.exists():
+    async def _finish_turn(self, chat_id: int, history: list, user_text: str, trace: list, response: str) -> bool:
+        """
+        保存历史并删除检查点（不会被取消打断，否则检查点会残留并在重启后重跑）
+        
+        Returns:
+            保存期间是否收到了取消请求
+        """
+        save = asyncio.ensure_future(self._save_turn(chat_id, history, user_text, trace, response))
+        cancelled = False
+        while True:
             try:
-                history = json.loads(session_file.read_text(encoding="utf-8"))
-                logger.debug(f"Loaded history for {chat_id}: {len(history)} messages")
-                return history
-            except Exception as e:
-                logger.error(f"Failed to load history for {chat_id}: {e}")
-                return []
-        return []
-    
-    def _save_history(self, chat_id: int, history: list):
-        """保存会话历史"""
-        session_file = self._get_session_file(chat_id)
+                await asyncio.shield(save)
+                return cancelled
+            except asyncio.CancelledError:
+                if save.done():
+                    raise
+                cancelled = True
+    
+    async def _save_turn(self, chat_id: int, history: list, user_text: str, trace: list, response: str):
+        """保存历史（包含中间的工具调用）并删除检查点"""
+        history.append({"role": "user", "content": user_text})
+        history.extend(trace)
+        history.append({"role": "assistant", "content": response})
+        await self.sessions.save_history(chat_id, history)
+        await self.sessions.clear_pending(chat_id)
+        if self.memory:
+            await asyncio.to_thread(self.memory.update, chat_id, history)
+    
+    async def _execute_turn(self, chat_id: int, user_text: str, resume: Optional[list] = None) -> Optional[str]:
+        """
+        在可取消的任务中执行一轮对话（同一会话的轮次串行执行）
+        
+        Returns:
+            Agent 的响应文本（超出配额时为拒绝原因）；轮次被 /cancel 或新消息取消时返回 None
+        """
+        async with self._chat_locks[chat_id]:
+            # 排队期间前面的轮次可能已用完配额，拿到锁后重新检查（恢复的轮次已准入过）
+            if resume is None:
+                reason = self.usage.admit(chat_id)
+                if reason:
+                    logger.warning(f"Rejected queued message from {chat_id}: {reason}")
+                    return f"⏳ {reason}"
+            task = asyncio.create_task(self._run_turn(chat_id, user_text, resume))
+            self._turns[chat_id] = task
+            try:
+                return await task
+            except asyncio.CancelledError:
+                # 外层（handler 本身）被取消时继续向上传播
+                if not task.cancelled():
+                    raise
+                return None
+            finally:
+                if self._turns.get(chat_id) is task:
+                    del self._turns[chat_id]
+    
+    def _cancel_turn(self, chat_id: int) -> bool:
+        """取消会话中进行中的轮次，返回是否有轮次被取消"""
+        task = self._turns.get(chat_id)
+        if task and not task.done():
+            task.cancel()
+            return True
+        return False
+    
+    async def _on_archive(self, chat_ids: List[int]):
+        """会话归档后删除其记忆索引（恢复后检索时按历史重建）"""
+        if not self.memory:
+            return
+        for chat_id in chat_ids:
+            async with self._chat_locks[chat_id]:
+                await asyncio.to_thread(self.memory.delete, chat_id)
+
+    async def _post_init(self, app: Application):
+        """启动后：恢复中断的轮次，启动会话维护任务"""
+        await self._resume_pending(app)
+        app.create_task(self.sessions.run_maintenance(
+            ttl=config.SESSION_TTL_DAYS * 86400,
+            interval=config.SESSION_MAINTENANCE_INTERVAL,
+            on_archive=self._on_archive
+        ))
+        app.create_task(self.usage.run_flush())
+        
+        # 诊断：事件循环阻塞检测 + SIGUSR1 触发采样
+        if config.LOOP_BLOCK_THRESHOLD > 0:
+            watchdog = LoopWatchdog(config.LOOP_BLOCK_THRESHOLD, config.PROFILE_DIR / "loop_blocks.folded")
+            app.create_task(watchdog.run())
         try:
-            session_file.write_text(
-                json.dumps(history, ensure_ascii=False, indent=2),
-                encoding="utf-8"
-            )
-            logger.debug(f"Saved history for {chat_id}: {len(history)} messages")
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, self._on_profile_signal, app)
+        except (AttributeError, NotImplementedError):
+            # Windows 不支持
+            pass
+    
+    async def _resume_pending(self, app: Application):
+        """启动时恢复上次中断的轮次"""
+        for chat_id in await self.sessions.pending_chat_ids():
+            pending = await self.sessions.load_pending(chat_id)
+            if not pending:
+                continue
+            logger.info(f"Resuming interrupted turn for {chat_id}")
+            app.create_task(self._resume_turn(app.bot, chat_id, pending))
+    
+    async def _resume_turn(self, bot: Bot, chat_id: int, pending: dict):
+        """继续执行中断的轮次并发送结果"""
+        try:
+            await bot.send_message(chat_id, "🔄 正在继续上次中断的任务…")
+            response = await self._execute_turn(chat_id, pending["user_message"], resume=pending["trace"])
+            if response is None:
+                await bot.send_message(chat_id, "⏹️ 已取消当前任务")
+                return
+            await self._send_response(bot, chat_id, response)
+            logger.info(f"Sent resumed response to {chat_id}: {response[:50]}...")
         except Exception as e:
-            logger.error(f"Failed to save history for {chat_id}: {e}")
+            logger.error(f"Error resuming turn for {chat_id}: {e}")
     
     async def handle_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理 /start 命令"""
@@ -66,6 +229,7 @@ class TelegramBot:
             "命令：\n"
             "/start - 显示欢迎消息\n"
             "/clear - 清空对话历史\n"
+            "/cancel - 取消进行中的任务\n"
             "/status - 查看状态"
         )
         await update.message.reply_text(welcome_msg)
@@ -74,23 +238,88 @@ class TelegramBot:
     async def handle_clear(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理 /clear 命令（清空历史）"""
         chat_id = update.effective_chat.id
-        session_file = self._get_session_file(chat_id)
         
-        if session_file.exists():
-            session_file.unlink()
+        # 先取消进行中的轮次并等待它写完历史，否则它会把旧历史写回
+        self._cancel_turn(chat_id)
+        async with self._chat_locks[chat_id]:
+            await self.sessions.clear_pending(chat_id)
+            if self.memory:
+                await asyncio.to_thread(self.memory.delete, chat_id)
+            cleared = await self.sessions.delete_history(chat_id)
+        
+        if cleared:
             await update.message.reply_text("✅ 已清空对话历史")
             logger.info(f"Cleared history for {chat_id}")
         else:
             await update.message.reply_text("ℹ️ 没有对话历史")
     
+    async def handle_cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """处理 /cancel 命令（取消进行中的任务）"""
+        chat_id = update.effective_chat.id
+        
+        # 取消成功时由 handle_message 回复
+        if not self._cancel_turn(chat_id):
+            await update.message.reply_text("ℹ️ 没有进行中的任务")
+        else:
+            logger.info(f"Cancel requested for {chat_id}")
+    
+    async def handle_profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """处理 /profile [秒数] 命令（仅管理员）：采样 profile 并发送 folded stack 文件"""
+        user_id = update.effective_user.id
+        if user_id not in config.ADMIN_IDS:
+            await update.message.reply_text("🚫 无权限")
+            return
+        if self.profiler.running:
+            await update.message.reply_text("ℹ️ 采样正在进行中")
+            return
+        
+        try:
+            seconds = float(context.args[0]) if context.args else config.PROFILE_SECONDS
+        except ValueError:
+            await update.message.reply_text("用法：/profile [秒数]")
+            return
+        seconds = min(max(seconds, 1), config.PROFILE_MAX_SECONDS)
+        
+        await update.message.reply_text(f"⏱️ 开始采样 {seconds:g} 秒…")
+        path = await self._profile(seconds)
+        
+        top = "\n".join(f"{count:>6}  {frame}" for frame, count in self.profiler.top(10))
+        with path.open("rb") as f:
+            await context.bot.send_document(
+                update.effective_chat.id,
+                document=f,
+                filename=path.name,
+                caption=f"🔥 事件循环线程热点（采样数）\n{top or '无'}"[:1024]
+            )
+    
+    def _on_profile_signal(self, app: Application):
+        """SIGUSR1：后台采样 PROFILE_SECONDS 秒"""
+        if self.profiler.running:
+            logger.info("Profiler already running, ignoring SIGUSR1")
+            return
+        app.create_task(self._profile(config.PROFILE_SECONDS))
+    
+    async def _profile(self, seconds: float) -> Path:
+        """采样指定秒数并把 folded stack 写入 PROFILE_DIR"""
+        self.profiler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self.profiler.stop()
+        path = config.PROFILE_DIR / f"profile_{time.strftime('%Y%m%d_%H%M%S')}.folded"
+        await asyncio.to_thread(self.profiler.dump, path)
+        logger.info(f"Profile written to {path}")
+        return path
+    
     async def handle_status(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理 /status 命令"""
         chat_id = update.effective_chat.id
-        history = self._load_history(chat_id)
+        history = await self.sessions.load_history(chat_id)
         
         # 统计消息数
         user_msgs = len([m for m in history if m.get("role") == "user"])
-        assistant_msgs = len([m for m in history if m.get("role") == "assistant"])
+        assistant_msgs = len([m for m in history if m.get("role") == "assistant" and not m.get("tool_calls")])
+        tool_msgs = len([m for m in history if m.get("role") == "tool"])
         
         status_msg = (
             f"📊 状态信息\n\n"
@@ -99,9 +328,13 @@ class TelegramBot:
             f"💬 历史消息: {len(history)} 条\n"
             f"  - 用户: {user_msgs} 条\n"
             f"  - 助手: {assistant_msgs} 条\n"
+            f"  - 工具调用: {tool_msgs} 次\n"
             f"📂 工作目录: {config.WORKSPACE}\n"
             f"🔧 最大迭代: {config.MAX_ITERATIONS}"
         )
+        status_msg += f"\n📈 Token 用量\n{self.usage.summary(chat_id)}"
+        if self.router:
+            status_msg += f"\n⚡ 快速模型: {config.FAST_MODEL}\n{self.router.summary()}"
         await update.message.reply_text(status_msg)
     
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -114,20 +347,26 @@ class TelegramBot:
         # 发送"正在输入"状态
         await update.message.chat.send_action("typing")
         
+        # 准入控制：超出 token 配额时拒绝
+        reason = self.usage.admit(chat_id)
+        if reason:
+            logger.warning(f"Rejected message from {chat_id}: {reason}")
+            await update.message.reply_text(f"⏳ {reason}")
+            return
+        
+        # 新消息取代进行中的轮次
+        if config.CANCEL_ON_NEW_MESSAGE and self._cancel_turn(chat_id):
+            logger.info(f"Superseding in-flight turn for {chat_id}")
+        
         try:
-            # 加载历史
-            history = self._load_history(chat_id)
-            
-            # 调用 agent 处理
-            response = await self.agent.process(user_text, history)
-            
-            # 保存历史
-            history.append({"role": "user", "content": user_text})
-            history.append({"role": "assistant", "content": response})
-            self._save_history(chat_id, history)
+            # 调用 agent 处理（逐次迭代保存检查点，可被取消）
+            response = await self._execute_turn(chat_id, user_text)
+            if response is None:
+                await update.message.reply_text("⏹️ 已取消当前任务")
+                return
             
             # 发送响应（处理长消息）
-            await self._send_response(update, response)
+            await self._send_response(context.bot, chat_id, response)
             
             logger.info(f"Sent response to {chat_id}: {response[:50]}...")
         
@@ -135,36 +374,67 @@ class TelegramBot:
             logger.error(f"Error handling message: {e}")
             await update.message.reply_text(f"❌ 处理消息时出错：{str(e)}")
     
-    async def _send_response(self, update: Update, text: str):
+    async def _send_response(self, bot: Bot, chat_id: int, text: str):
         """发送响应（处理 Telegram 4096 字符限制）"""
         MAX_LENGTH = 4096
         
         if len(text) <= MAX_LENGTH:
-            await update.message.reply_text(text)
+            await bot.send_message(chat_id, text)
+        elif len(text) > config.DOCUMENT_THRESHOLD:
+            # 超长内容：以文件形式一次性发送，附带简短预览
+            await self._send_as_document(bot, chat_id, text)
         else:
             # 分段发送
             chunks = [text[i:i+MAX_LENGTH] for i in range(0, len(text), MAX_LENGTH)]
             for i, chunk in enumerate(chunks, 1):
                 prefix = f"📄 {i}/{len(chunks)}\n\n" if len(chunks) > 1 else ""
-                await update.message.reply_text(prefix + chunk)
+                await bot.send_message(chat_id, prefix + chunk)
                 await asyncio.sleep(0.5)  # 避免速率限制
     
+    async def _send_as_document(self, bot: Bot, chat_id: int, text: str):
+        """以内存文件形式发送长响应"""
+        data = text.encode("utf-8")
+        preview = text[:config.DOCUMENT_SUMMARY_LENGTH].rstrip()
+        if len(text) > config.DOCUMENT_SUMMARY_LENGTH:
+            preview += "…"
+        
+        # caption 上限 1024 字符
+        caption = f"📎 响应较长（{len(text)} 字符），已作为文件发送\n\n{preview}"[:1024]
+        
+        await bot.send_document(
+            chat_id,
+            document=io.BytesIO(data),
+            filename="response.md",
+            caption=caption
+        )
+        logger.debug(f"Sent response as document: {len(data)} bytes")
+    
     def run(self):
         """启动 Bot"""
         logger.info("Starting Telegram bot...")
         
         # 创建 Application
-        app = Application.builder().token(config.TELEGRAM_TOKEN).build()
+        app = (
+            Application.builder()
+            .token(config.TELEGRAM_TOKEN)
+            .post_init(self._post_init)
+            .concurrent_updates(True)  # 允许 /cancel 在任务执行期间被处理
+            .build()
+        )
         
         # 注册处理器
         app.add_handler(CommandHandler("start", self.handle_start))
         app.add_handler(CommandHandler("clear", self.handle_clear))
+        app.add_handler(CommandHandler("cancel", self.handle_cancel))
         app.add_handler(CommandHandler("status", self.handle_status))
+        app.add_handler(CommandHandler("profile", self.handle_profile))
         app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
         
         # 启动轮询
         logger.info(f"Bot is running (model: {config.LLM_MODEL})")
         app.run_polling(allowed_updates=Update.ALL_TYPES)
+        self.sessions.close()
+        self.usage.save()
 
 
 def main():
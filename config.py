@@ -13,6 +13,9 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4o-mini")
 API_KEY = os.getenv("API_KEY")
 
+# 快速模型（可选）：设置后简单消息先交给它，需要工具或低置信度时升级到 LLM_MODEL
+FAST_MODEL = os.getenv("FAST_MODEL", None)
+
 # 如果使用自定义 API 端点
 BASE_URL = os.getenv("BASE_URL", None)
 
@@ -28,9 +31,49 @@ SESSION_DIR = BASE_DIR / "sessions"
 WORKSPACE.mkdir(exist_ok=True)
 SESSION_DIR.mkdir(exist_ok=True)
 
+# 会话存储配置
+# fsync 策略：never（依赖系统缓存，最快）/ always（每次写入后 fsync，断电安全）
+SESSION_FSYNC = os.getenv("SESSION_FSYNC", "never")
+# 会话编码：json（默认，可读）/ msgpack（msgpack + zstd，需要 pip install msgpack zstandard）
+SESSION_ENCODING = os.getenv("SESSION_ENCODING", "json")
+# 闲置超过该天数的会话压缩归档到 sessions/archive/（0 表示不归档），再次对话时自动恢复
+SESSION_TTL_DAYS = float(os.getenv("SESSION_TTL_DAYS", "30"))
+SESSION_MAINTENANCE_INTERVAL = 3600  # 后台维护间隔（秒）
+
+# 检索记忆（需要 pip install numpy）：只注入相关的早期轮次 + 最近窗口，而不是完整历史
+RETRIEVAL_ENABLED = os.getenv("RETRIEVAL_ENABLED", "false").lower() == "true"
+RETRIEVAL_TOP_K = 3           # 检索的早期轮次数
+RETRIEVAL_RECENT_TURNS = 3    # 始终完整保留的最近轮次数
+# 自定义嵌入函数 "模块:函数"（接收文本列表，返回 (n, dim) 数组），留空使用哈希词袋
+RETRIEVAL_EMBEDDER = os.getenv("RETRIEVAL_EMBEDDER", None)
+
+# Token 配额（0 表示不限制），超出后新消息会被拒绝
+CHAT_TOKENS_PER_MINUTE = int(os.getenv("CHAT_TOKENS_PER_MINUTE", "0"))
+CHAT_TOKENS_PER_DAY = int(os.getenv("CHAT_TOKENS_PER_DAY", "0"))
+GLOBAL_TOKENS_PER_MINUTE = int(os.getenv("GLOBAL_TOKENS_PER_MINUTE", "0"))
+GLOBAL_TOKENS_PER_DAY = int(os.getenv("GLOBAL_TOKENS_PER_DAY", "0"))
+
+# 诊断配置
+# 管理员 Telegram 用户 ID（逗号分隔），可使用 /profile
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+PROFILE_DIR = BASE_DIR / "profiles"   # profile 输出目录（folded stack，可用 flamegraph.pl / speedscope 查看）
+PROFILE_SECONDS = 30                  # /profile 和 SIGUSR1 默认采样时长（秒）
+PROFILE_MAX_SECONDS = 300
+# 事件循环阻塞超过该秒数时记录调用栈（0 表示关闭）
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", "1.0"))
+
 # Agent 配置
 MAX_ITERATIONS = 10  # 最大工具调用轮次
 SHELL_TIMEOUT = 30   # Shell 命令超时（秒）
+CONTEXT_TOKEN_LIMIT = 12000      # 超过该估算 token 数时压缩较早的工具结果
+KEEP_RECENT_TOOL_RESULTS = 2     # 压缩时保留完整内容的最近工具结果数
+# 同一会话收到新消息时取消进行中的任务（否则排队等待）
+CANCEL_ON_NEW_MESSAGE = os.getenv("CANCEL_ON_NEW_MESSAGE", "false").lower() == "true"
+
+# 消息发送配置
+# 超过该字符数的响应改为以文件形式发送（避免几十条分段消息）
+DOCUMENT_THRESHOLD = int(os.getenv("DOCUMENT_THRESHOLD", "12000"))
+DOCUMENT_SUMMARY_LENGTH = 300  # 以文件发送时，内联预览的字符数
 
 # 验证必要的配置
 if not TELEGRAM_TOKEN:
@@ -0,0 +1,138 @@
+"""Diagnostics - 采样 profiler 和事件循环阻塞检测
+
+输出为 folded stack 格式（每行 "帧1;帧2;... 次数"），可直接用 flamegraph.pl 或 speedscope 查看。
+"""
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from pathlib import Path
+from typing import List, Optional, Tuple
+from loguru import logger
+
+
+def _fold_stack(frame, root: str) -> str:
+    """把帧链转换为 folded stack 字符串（根在前）"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join([root] + names[::-1])
+
+
+class SamplingProfiler:
+    """
+    纯 Python 采样 profiler
+
+    后台线程按固定间隔采样所有线程的调用栈，无需修改被测代码，开销与采样频率成正比。
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """开始采样"""
+        self.samples.clear()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        logger.info(f"Sampling profiler started (interval={self.interval * 1000:.1f}ms)")
+
+    def stop(self) -> Counter:
+        """停止采样，返回 folded stack -> 采样次数"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        logger.info(f"Sampling profiler stopped: {sum(self.samples.values())} samples")
+        return self.samples
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                self.samples[_fold_stack(frame, names.get(ident, str(ident)))] += 1
+
+    def dump(self, path: Path):
+        """写入 folded stack 文件"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("w", encoding="utf-8") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def top(self, n: int = 10, thread: str = "MainThread") -> List[Tuple[str, int]]:
+        """指定线程中自身采样数最多的函数（栈顶帧）"""
+        leaves: Counter = Counter()
+        for stack, count in self.samples.items():
+            frames = stack.split(";")
+            if frames[0] == thread and len(frames) > 1:
+                leaves[frames[-1]] += count
+        return leaves.most_common(n)
+
+
+class LoopWatchdog:
+    """
+    事件循环阻塞检测
+
+    事件循环中的心跳协程定期更新时间戳；监控线程发现心跳停滞超过 threshold 秒时，
+    抓取事件循环线程的调用栈写入日志，并追加到 folded stack 文件（权重为阻塞毫秒数）。
+    """
+
+    def __init__(self, threshold: float = 1.0, output: Optional[Path] = None):
+        self.threshold = threshold
+        self.output = output
+        self._last_tick = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._stop = threading.Event()
+
+    async def run(self):
+        """在事件循环中运行：启动监控线程并持续发送心跳"""
+        self._loop_thread_id = threading.get_ident()
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        logger.info(f"Loop watchdog started (threshold={self.threshold}s)")
+        try:
+            while True:
+                self._last_tick = time.monotonic()
+                await asyncio.sleep(self.threshold / 4)
+        finally:
+            self._stop.set()
+
+    def _watch(self):
+        # 当前阻塞：(心跳时间戳, folded stack)，阻塞结束后按实际时长写入
+        pending = None
+        while not self._stop.wait(self.threshold / 4):
+            last = self._last_tick
+            if pending and pending[0] != last:
+                self._record(pending[1], last - pending[0])
+                pending = None
+
+            blocked = time.monotonic() - last
+            if blocked < self.threshold or pending:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            # 每次阻塞只在检测到时记录一次调用栈
+            stack = "".join(traceback.format_stack(frame))
+            logger.warning(f"Event loop blocked for {blocked:.2f}s so far:\n{stack}")
+            pending = (last, _fold_stack(frame, "loop-block"))
+
+    def _record(self, folded: str, duration: float):
+        """阻塞结束：记录总时长并追加到 folded stack 文件"""
+        logger.warning(f"Event loop unblocked after {duration:.2f}s")
+        if self.output:
+            self.output.parent.mkdir(parents=True, exist_ok=True)
+            with self.output.open("a", encoding="utf-8") as f:
+                f.write(f"{folded} {int(duration * 1000)}\n")
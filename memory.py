@@ -0,0 +1,200 @@
+"""Memory - 基于向量检索的会话记忆"""
+import importlib
+import json
+import re
+import zlib
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+from loguru import logger
+
+from session import SessionStore, atomic_write
+
+# 可选依赖：向量检索（pip install numpy）
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# 英文单词 / 数字，以及单个 CJK 字符
+TOKEN_PATTERN = re.compile(r"[a-zA-Z_][a-zA-Z0-9_]*|\d+|[一-鿿]")
+
+
+def hashed_bow_embedding(texts: List[str], dim: int = 512) -> "np.ndarray":
+    """
+    哈希词袋向量（无需模型的默认嵌入）
+
+    英文按单词、中文按单字和相邻双字切分，用 crc32 哈希到 dim 维并 L2 归一化。
+    """
+    vectors = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        tokens = TOKEN_PATTERN.findall(text.lower())
+        grams = tokens + [a + b for a, b in zip(tokens, tokens[1:])]
+        for gram in grams:
+            h = zlib.crc32(gram.encode("utf-8"))
+            vectors[row, h % dim] += 1.0 if (h >> 31) & 1 else -1.0
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def load_embedder(spec: Optional[str]) -> Callable[[List[str]], "np.ndarray"]:
+    """
+    加载嵌入函数
+
+    Args:
+        spec: "模块:函数"，函数接收文本列表、返回 (n, dim) 数组；为空时使用哈希词袋
+    """
+    if not spec:
+        return hashed_bow_embedding
+    module_name, func_name = spec.split(":")
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+def split_turns(history: List[Dict]) -> List[Tuple[int, int]]:
+    """把历史切分为轮次，返回每轮在 history 中的 [start, end) 区间"""
+    starts = [i for i, m in enumerate(history) if m.get("role") == "user"]
+    return [
+        (start, starts[n + 1] if n + 1 < len(starts) else len(history))
+        for n, start in enumerate(starts)
+    ]
+
+
+def turn_summary(history: List[Dict], start: int, end: int) -> List[Dict]:
+    """一轮对话的精简形式：用户消息 + 最终回复（不含中间工具调用）"""
+    final = next(
+        (m for m in reversed(history[start:end]) if m.get("role") == "assistant" and not m.get("tool_calls")),
+        None
+    )
+    return [history[start]] + ([{"role": "assistant", "content": final["content"]}] if final else [])
+
+
+def summarize_history(history: List[Dict]) -> List[Dict]:
+    """把历史精简为每轮的用户消息 + 最终回复（去掉中间的工具调用轨迹）"""
+    return [m for start, end in split_turns(history) for m in turn_summary(history, start, end)]
+
+
+class MemoryIndex:
+    """
+    每个会话一份向量索引
+
+    向量以 float32 追加写入 <分片>/<chat_id>.vec，查询时用 np.memmap 只读映射；
+    <分片>/<chat_id>.meta.json 记录已索引的轮次区间，每次保存历史后增量更新。
+    分片与 SessionStore 一致；索引可由历史重建，缺失时在检索前补建。
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        embed_fn: Optional[Callable[[List[str]], "np.ndarray"]] = None,
+        top_k: int = 3,
+        recent_turns: int = 3
+    ):
+        if np is None:
+            raise ValueError("检索记忆需要安装 numpy")
+        self.directory = directory
+        self.embed_fn = embed_fn or hashed_bow_embedding
+        self.top_k = top_k
+        self.recent_turns = recent_turns
+        self.directory.mkdir(parents=True, exist_ok=True)
+        logger.info(f"MemoryIndex initialized: directory={directory}, top_k={top_k}, recent_turns={recent_turns}")
+
+    def _vec_path(self, chat_id: int) -> Path:
+        return self.directory / SessionStore.shard(chat_id) / f"{chat_id}.vec"
+
+    def _meta_path(self, chat_id: int) -> Path:
+        return self.directory / SessionStore.shard(chat_id) / f"{chat_id}.meta.json"
+
+    def _load_meta(self, chat_id: int) -> Dict:
+        path = self._meta_path(chat_id)
+        if path.exists():
+            return json.loads(path.read_text(encoding="utf-8"))
+        return {"dim": None, "turns": []}
+
+    def _write_meta(self, chat_id: int, meta: Dict):
+        """原子写入 meta"""
+        atomic_write(self._meta_path(chat_id), json.dumps(meta).encode("utf-8"))
+
+    def _is_stale(self, meta: Dict, turns: List[Tuple[int, int]]) -> bool:
+        """meta 是否未覆盖 turns 或与之不一致（meta 可以多索引后面的轮次）"""
+        indexed = [tuple(t) for t in meta["turns"]]
+        return indexed[:len(turns)] != turns
+
+    def update(self, chat_id: int, history: List[Dict]):
+        """为尚未索引的轮次计算向量并追加到索引"""
+        meta = self._load_meta(chat_id)
+        turns = split_turns(history)
+        indexed = [tuple(t) for t in meta["turns"]]
+
+        vec_path = self._vec_path(chat_id)
+        vec_path.parent.mkdir(exist_ok=True)
+        # meta 记录的向量字节数；.vec 比它长说明上次追加后、写 meta 前中断
+        expected = len(indexed) * (meta["dim"] or 0) * 4
+        vec_size = vec_path.stat().st_size if vec_path.exists() else 0
+
+        # 历史被清空或改写、或 .vec 缺失数据时重建
+        if turns[:len(indexed)] != indexed or vec_size < expected:
+            logger.info(f"Rebuilding memory index for {chat_id}")
+            self.delete(chat_id)
+            meta, indexed, expected = {"dim": None, "turns": []}, [], 0
+
+        new_turns = turns[len(indexed):]
+        if not new_turns:
+            return
+
+        texts = [
+            "\n".join(m.get("content") or "" for m in turn_summary(history, start, end))
+            for start, end in new_turns
+        ]
+        vectors = np.asarray(self.embed_fn(texts), dtype=np.float32)
+        with vec_path.open("ab") as f:
+            f.truncate(expected)
+            f.write(vectors.tobytes())
+
+        meta["dim"] = int(vectors.shape[1])
+        meta["turns"] = [list(t) for t in indexed + new_turns]
+        self._write_meta(chat_id, meta)
+        logger.debug(f"Indexed {len(new_turns)} turns for {chat_id} (total {len(meta['turns'])})")
+
+    def select_history(self, chat_id: int, history: List[Dict], query: str) -> List[Dict]:
+        """
+        构造注入 Agent 的历史：最相关的 top_k 个早期轮次（精简形式）+ 最近的完整轮次
+
+        Args:
+            chat_id: 会话 ID
+            history: 完整历史
+            query: 当前用户消息
+        """
+        turns = split_turns(history)
+        if len(turns) <= self.recent_turns:
+            return history
+
+        recent_start = turns[-self.recent_turns][0]
+        older = turns[:-self.recent_turns]
+        meta = self._load_meta(chat_id)
+        # 索引尚未建立（如刚开启检索）或落后于历史时，先补建
+        if self._is_stale(meta, older):
+            self.update(chat_id, history)
+            meta = self._load_meta(chat_id)
+        count = min(len(meta["turns"]), len(older))
+
+        selected: List[Tuple[int, int]] = []
+        if count and self.top_k:
+            matrix = np.memmap(self._vec_path(chat_id), dtype=np.float32, mode="r").reshape(-1, meta["dim"])
+            query_vec = np.asarray(self.embed_fn([query]), dtype=np.float32)[0]
+            scores = matrix[:count] @ query_vec
+            best = np.argsort(-scores)[:self.top_k]
+            selected = sorted(tuple(meta["turns"][i]) for i in best if scores[i] > 0)
+            del matrix
+
+        messages = []
+        for start, end in selected:
+            messages.extend(turn_summary(history, start, end))
+        logger.debug(f"Retrieved {len(selected)} past turns for {chat_id}")
+        return messages + history[recent_start:]
+
+    def delete(self, chat_id: int):
+        """删除会话的索引（包括旧的扁平布局）"""
+        for path in (self._vec_path(chat_id), self._meta_path(chat_id)):
+            path.unlink(missing_ok=True)
+            (self.directory / path.name).unlink(missing_ok=True)
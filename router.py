@@ -0,0 +1,117 @@
+"""Router - 按任务难度和观测延迟选择模型"""
+import re
+from typing import Dict, Optional
+from loguru import logger
+
+
+# 出现这些内容时认为任务可能需要工具，直接使用强模型
+# 中文没有词边界，按子串匹配
+TOOL_HINTS_CJK = ("文件", "目录", "执行", "运行", "命令", "代码", "脚本", "创建", "读取", "写入", "修改", "安装")
+# 英文按整词匹配（避免 "already" 命中 "read"）
+TOOL_HINT_WORDS = {
+    "file", "files", "dir", "directory", "folder", "run", "exec", "execute", "shell", "command",
+    "code", "script", "create", "read", "write", "install", "ls", "cat", "pip", "git",
+}
+WORD_PATTERN = re.compile(r"[a-z]+")
+# 代码块、路径（/a、./a、~/a）、带常见扩展名的文件名
+TOOL_HINT_PATTERN = re.compile(
+    r"```|(?:^|\s)(?:~|\.{1,2})?/[\w.-]+|\b[\w-]+\.(?:py|js|ts|sh|json|md|txt|ya?ml|toml|csv|html|css)\b"
+)
+
+
+class ModelRouter:
+    """
+    快慢模型路由
+
+    简单消息的第一轮交给快速模型；需要工具、低置信度（空响应或被截断）
+    或快速模型实际并不更快时，升级到强模型。
+    """
+
+    def __init__(
+        self,
+        fast_model: str,
+        strong_model: str,
+        simple_max_chars: int = 200,
+        min_samples: int = 5,
+        ewma_alpha: float = 0.2,
+        explore_every: int = 20
+    ):
+        self.fast_model = fast_model
+        self.strong_model = strong_model
+        self.simple_max_chars = simple_max_chars
+        self.min_samples = min_samples
+        self.ewma_alpha = ewma_alpha
+        self.explore_every = explore_every
+        # 因快速模型较慢而改用强模型的次数，达到 explore_every 时试探一次快速模型
+        self._fast_skipped = 0
+        # 模型 -> {"calls": 调用次数, "latency": 延迟 EWMA（秒）}
+        self.stats: Dict[str, Dict[str, float]] = {}
+        logger.info(f"ModelRouter initialized: fast={fast_model}, strong={strong_model}")
+
+    def is_simple(self, user_message: str) -> bool:
+        """粗略判断消息是否简单（短且不涉及工具）"""
+        if len(user_message) > self.simple_max_chars:
+            return False
+        text = user_message.lower()
+        if any(hint in text for hint in TOOL_HINTS_CJK):
+            return False
+        if TOOL_HINT_WORDS.intersection(WORD_PATTERN.findall(text)):
+            return False
+        return not TOOL_HINT_PATTERN.search(text)
+
+    def select(self, user_message: str, iteration: int) -> str:
+        """
+        选择本次迭代使用的模型
+
+        Args:
+            user_message: 用户消息
+            iteration: 当前迭代序号（从 1 开始）
+        """
+        # 进入第二轮说明已经在使用工具
+        if iteration > 1 or not self.is_simple(user_message):
+            return self.strong_model
+        if not self._fast_is_faster():
+            # 偶尔试探快速模型，让它的延迟统计有机会恢复
+            self._fast_skipped += 1
+            if self._fast_skipped < self.explore_every:
+                return self.strong_model
+            self._fast_skipped = 0
+            logger.debug(f"Exploring fast model {self.fast_model}")
+        return self.fast_model
+
+    def should_escalate(self, model: str, message, finish_reason: Optional[str]) -> bool:
+        """
+        快速模型的响应是否需要交给强模型重做
+
+        空响应或因长度截断视为低置信度；快速模型发起工具调用说明任务不简单。
+        """
+        if model != self.fast_model or model == self.strong_model:
+            return False
+        if message.tool_calls:
+            return True
+        return not (message.content or "").strip() or finish_reason == "length"
+
+    def record(self, model: str, latency: float):
+        """记录一次调用延迟（秒）"""
+        stat = self.stats.setdefault(model, {"calls": 0, "latency": latency})
+        stat["calls"] += 1
+        stat["latency"] += self.ewma_alpha * (latency - stat["latency"])
+
+    def _fast_is_faster(self) -> bool:
+        """样本足够时，快速模型的平均延迟必须低于强模型"""
+        fast = self.stats.get(self.fast_model)
+        strong = self.stats.get(self.strong_model)
+        if not fast or not strong:
+            return True
+        if fast["calls"] < self.min_samples or strong["calls"] < self.min_samples:
+            return True
+        return fast["latency"] < strong["latency"]
+
+    def summary(self) -> str:
+        """各模型的调用统计（用于 /status）"""
+        if not self.stats:
+            return "暂无调用"
+        return "\n".join(
+            f"  - {model}: {int(stat['calls'])} 次，平均 {stat['latency']:.2f}s"
+            for model, stat in self.stats.items()
+        )
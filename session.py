@@ -0,0 +1,469 @@
+"""Session - 会话历史的异步存储
+
+迁移旧的扁平目录布局（sessions/<chat_id>.json）到分片布局：
+    python session.py migrate --dir sessions
+"""
+import argparse
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from loguru import logger
+
+# 可选依赖：紧凑二进制编码（pip install msgpack zstandard）
+try:
+    import msgpack
+    import zstandard
+except ImportError:
+    msgpack = None
+    zstandard = None
+
+# zstd 帧头魔数，用于读取时自动识别编码
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# 编码 -> 会话文件扩展名
+ENCODING_SUFFIXES = {
+    "json": ".json",
+    "msgpack": ".msgpack.zst",
+}
+
+
+def encode_session(data: Any, encoding: str = "json", indent: Optional[int] = None) -> bytes:
+    """
+    把会话数据编码为字节
+
+    Args:
+        data: 会话数据（可 JSON 序列化）
+        encoding: json（可读）或 msgpack（msgpack + zstd 压缩）
+        indent: JSON 缩进（仅 json 编码）
+    """
+    if encoding == "json":
+        return json.dumps(data, ensure_ascii=False, indent=indent).encode("utf-8")
+    if encoding == "msgpack":
+        return zstandard.ZstdCompressor(level=3).compress(msgpack.packb(data, use_bin_type=True))
+    raise ValueError(f"未知的会话编码：{encoding}")
+
+
+def decode_session(raw: bytes) -> Any:
+    """解码会话数据，根据内容自动识别编码"""
+    if raw.startswith(ZSTD_MAGIC):
+        if msgpack is None:
+            raise RuntimeError("读取 msgpack 会话需要安装 msgpack 和 zstandard")
+        return msgpack.unpackb(zstandard.ZstdDecompressor().decompress(raw), raw=False)
+    return json.loads(raw.decode("utf-8"))
+
+
+def atomic_write(path: Path, payload: bytes, fsync: bool = False):
+    """
+    写入临时文件后 os.replace，避免崩溃时留下半个文件
+
+    Args:
+        path: 目标文件（父目录不存在时创建）
+        payload: 文件内容
+        fsync: 是否在 rename 前后 fsync 文件和目录（断电时也不丢失）
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_name, path)
+    except BaseException:
+        Path(tmp_name).unlink(missing_ok=True)
+        raise
+
+    if fsync:
+        # 确保 rename 本身落盘
+        dir_fd = os.open(path.parent, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class KeyedLock:
+    """
+    按键划分的 asyncio 锁，用法与 defaultdict(asyncio.Lock) 相同：async with locks[key]
+
+    没有协程持有或等待的锁会被移除，占用只与同时使用的键数有关。
+    """
+
+    def __init__(self):
+        # key -> [锁, 持有或等待的协程数]
+        self._entries: Dict[Any, list] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @asynccontextmanager
+    async def __getitem__(self, key):
+        entry = self._entries.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._entries[key]
+
+
+class SessionStore:
+    """
+    会话文件存储
+
+    所有磁盘 I/O 都在专用线程池中执行，不阻塞事件循环；
+    同一文件的读写通过锁串行化，写入使用临时文件 + rename 保证原子性。
+    会话历史按 encoding 写入；读取时自动识别编码，旧格式文件在下次保存时迁移。
+
+    文件按 chat_id 哈希前缀分片存放（<shard>/<chat_id>.json），避免单个目录过大；
+    activity.json 记录每个会话的最后活动时间，后台任务把超过 TTL 的会话
+    gzip 压缩到 archive/，再次加载时透明恢复。
+    """
+
+    ACTIVITY_FILE = "activity.json"
+    ARCHIVE_DIR = "archive"
+
+    FSYNC_POLICIES = ("never", "always")
+
+    def __init__(
+        self,
+        directory: Path,
+        fsync: str = "never",
+        encoding: str = "json",
+        max_workers: int = 4
+    ):
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError(f"未知的 fsync 策略：{fsync}（可选：{', '.join(self.FSYNC_POLICIES)}）")
+        if encoding not in ENCODING_SUFFIXES:
+            raise ValueError(f"未知的会话编码：{encoding}（可选：{', '.join(ENCODING_SUFFIXES)}）")
+        if encoding == "msgpack" and msgpack is None:
+            raise ValueError("SESSION_ENCODING=msgpack 需要安装 msgpack 和 zstandard")
+        self.directory = directory
+        self.fsync = fsync
+        self.encoding = encoding
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="session-io")
+        self._locks = KeyedLock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # chat_id -> 最后活动时间戳
+        self._activity: Dict[str, float] = self._load_activity()
+        self._activity_dirty = False
+        logger.info(f"SessionStore initialized: directory={directory}, fsync={fsync}, encoding={encoding}")
+
+    @staticmethod
+    def shard(chat_id: int) -> str:
+        """chat_id 所在的分片目录名（哈希前 2 位，共 256 个分片）"""
+        return hashlib.md5(str(chat_id).encode("utf-8")).hexdigest()[:2]
+
+    def history_path(self, chat_id: int) -> Path:
+        """会话历史文件路径（当前编码）"""
+        return self.directory / self.shard(chat_id) / f"{chat_id}{ENCODING_SUFFIXES[self.encoding]}"
+
+    def _history_candidates(self, chat_id: int) -> List[Path]:
+        """
+        所有可能的会话历史文件，当前编码优先
+
+        依次为：分片目录中的其他编码、旧的扁平布局、归档文件。
+        """
+        suffixes = [ENCODING_SUFFIXES[self.encoding]] + [
+            suffix for encoding, suffix in ENCODING_SUFFIXES.items()
+            if encoding != self.encoding
+        ]
+        shard_dir = self.directory / self.shard(chat_id)
+        archive_dir = self.directory / self.ARCHIVE_DIR / self.shard(chat_id)
+        return (
+            [shard_dir / f"{chat_id}{suffix}" for suffix in suffixes]
+            + [self.directory / f"{chat_id}{suffix}" for suffix in suffixes]
+            + [archive_dir / f"{chat_id}{suffix}.gz" for suffix in suffixes]
+        )
+
+    def pending_path(self, chat_id: int) -> Path:
+        """进行中轮次的检查点文件路径"""
+        return self.directory / self.shard(chat_id) / f"{chat_id}.pending.json"
+
+    def _pending_candidates(self, chat_id: int) -> List[Path]:
+        """所有可能的检查点文件：分片目录优先，其次旧的扁平布局"""
+        return [self.pending_path(chat_id), self.directory / f"{chat_id}.pending.json"]
+
+    async def load_history(self, chat_id: int) -> list:
+        """加载会话历史（不存在或损坏时返回空列表）"""
+        try:
+            history = await self._read_first(self._history_candidates(chat_id))
+        except Exception as e:
+            logger.error(f"Failed to load history for {chat_id}: {e}")
+            return []
+        if history is None:
+            return []
+        logger.debug(f"Loaded history for {chat_id}: {len(history)} messages")
+        return history
+
+    async def save_history(self, chat_id: int, history: list):
+        """保存会话历史"""
+        try:
+            await self._write_session(self._history_candidates(chat_id), history)
+            self._touch(chat_id)
+            logger.debug(f"Saved history for {chat_id}: {len(history)} messages")
+        except Exception as e:
+            logger.error(f"Failed to save history for {chat_id}: {e}")
+
+    async def delete_history(self, chat_id: int) -> bool:
+        """删除会话历史，返回文件是否存在"""
+        existed = False
+        for path in self._history_candidates(chat_id):
+            existed = await self._unlink(path) or existed
+        if self._activity.pop(str(chat_id), None) is not None:
+            self._activity_dirty = True
+        return existed
+
+    async def load_pending(self, chat_id: int) -> Optional[dict]:
+        """加载进行中轮次的检查点"""
+        try:
+            return await self._read_first(self._pending_candidates(chat_id))
+        except Exception as e:
+            logger.error(f"Failed to load checkpoint for {chat_id}: {e}")
+            return None
+
+    async def save_pending(self, chat_id: int, user_text: str, trace: list):
+        """保存进行中轮次的检查点（用户消息 + 已完成的工具调用轨迹）"""
+        try:
+            await self._write_json(
+                self.pending_path(chat_id),
+                {"user_message": user_text, "trace": trace}
+            )
+            logger.debug(f"Checkpointed turn for {chat_id}: {len(trace)} messages")
+        except Exception as e:
+            logger.error(f"Failed to checkpoint turn for {chat_id}: {e}")
+
+    async def clear_pending(self, chat_id: int):
+        """删除检查点"""
+        for path in self._pending_candidates(chat_id):
+            await self._unlink(path)
+
+    async def pending_chat_ids(self) -> List[int]:
+        """列出存在未完成轮次的会话"""
+        paths = await self._run(
+            lambda: list(self.directory.glob("*/*.pending.json")) + list(self.directory.glob("*.pending.json"))
+        )
+        return [int(p.name.split(".")[0]) for p in paths]
+
+    def _load_activity(self) -> Dict[str, float]:
+        """加载最后活动时间索引"""
+        path = self.directory / self.ACTIVITY_FILE
+        if not path.exists():
+            return {}
+        try:
+            return json.loads(path.read_text(encoding="utf-8"))
+        except Exception as e:
+            logger.error(f"Failed to load activity index: {e}")
+            return {}
+
+    def _touch(self, chat_id: int):
+        """更新会话的最后活动时间（内存中，定期落盘）"""
+        self._activity[str(chat_id)] = time.time()
+        self._activity_dirty = True
+
+    async def flush_activity(self):
+        """把最后活动时间索引写入磁盘"""
+        if not self._activity_dirty:
+            return
+        self._activity_dirty = False
+        await self._write_json(self.directory / self.ACTIVITY_FILE, dict(self._activity))
+
+    async def archive_idle(self, ttl: float) -> List[int]:
+        """
+        归档超过 ttl 秒未活动的会话
+
+        Returns:
+            归档的会话 ID
+        """
+        now = time.time()
+        idle = [int(chat_id) for chat_id, ts in self._activity.items() if now - ts > ttl]
+        archived = []
+        for chat_id in idle:
+            paths = self._history_candidates(chat_id)
+            async with self._locks[paths[0]]:
+                # 扫描期间会话可能重新活跃
+                ts = self._activity.get(str(chat_id))
+                if ts is None or time.time() - ts <= ttl:
+                    continue
+                result = await self._run(self._archive_sync, chat_id)
+                if result is None:
+                    continue
+                if result:
+                    archived.append(chat_id)
+                self._activity.pop(str(chat_id), None)
+                self._activity_dirty = True
+        if archived:
+            logger.info(f"Archived {len(archived)} idle sessions")
+        return archived
+
+    def _archive_sync(self, chat_id: int) -> Optional[bool]:
+        """
+        把会话的在用文件压缩到 archive/ 并删除原文件
+
+        Returns:
+            是否归档了文件；有未完成轮次时不归档，返回 None
+        """
+        if any(p.exists() for p in self._pending_candidates(chat_id)):
+            return None
+        archived = False
+        for path in self._history_candidates(chat_id):
+            if not path.exists() or path.suffix == ".gz":
+                continue
+            target = self.directory / self.ARCHIVE_DIR / self.shard(chat_id) / f"{path.name}.gz"
+            self._atomic_write(target, gzip.compress(path.read_bytes()))
+            path.unlink()
+            archived = True
+        return archived
+
+    async def run_maintenance(
+        self,
+        ttl: float,
+        interval: float = 3600,
+        on_archive: Optional[Callable[[List[int]], Awaitable[None]]] = None
+    ):
+        """
+        后台维护任务：定期归档闲置会话并写入活动时间索引
+
+        Args:
+            ttl: 闲置多少秒后归档（<= 0 表示不归档）
+            interval: 执行间隔（秒）
+            on_archive: 归档后回调（参数为归档的会话 ID），用于清理会话的派生数据
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if ttl > 0:
+                    archived = await self.archive_idle(ttl)
+                    if archived and on_archive:
+                        await on_archive(archived)
+                await self.flush_activity()
+            except Exception as e:
+                logger.error(f"Session maintenance failed: {e}")
+
+    async def _run(self, func, *args):
+        """
+        在 I/O 线程池中执行
+
+        调用方被取消时仍等待线程中的 I/O 完成再向上抛出，
+        保证持有的文件锁在 I/O 结束前不会释放（否则被取消的写入可能晚于后续的删除）。
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, func, *args)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            await asyncio.wait([future])
+            raise
+
+    async def _write_json(self, path: Path, data: Any):
+        """原子写入 JSON 文件"""
+        async with self._locks[path]:
+            await self._run(self._atomic_write, path, encode_session(data))
+
+    async def _read_first(self, paths: List[Path]) -> Any:
+        """按顺序读取第一个存在的会话文件（自动识别编码）"""
+        async with self._locks[paths[0]]:
+            return await self._run(self._read_first_sync, paths)
+
+    async def _write_session(self, paths: List[Path], data: Any):
+        """以当前编码写入 paths[0]，并删除其余旧格式文件（惰性迁移）"""
+        async with self._locks[paths[0]]:
+            await self._run(self._write_session_sync, paths, data)
+
+    async def _unlink(self, path: Path) -> bool:
+        """删除文件，返回文件是否存在"""
+        async with self._locks[path]:
+            return await self._run(self._unlink_sync, path)
+
+    def _read_first_sync(self, paths: List[Path]) -> Any:
+        for path in paths:
+            if path.exists():
+                raw = path.read_bytes()
+                if path.suffix == ".gz":
+                    raw = gzip.decompress(raw)
+                return decode_session(raw)
+        return None
+
+    def _write_session_sync(self, paths: List[Path], data: Any):
+        indent = 2 if self.encoding == "json" else None
+        self._atomic_write(paths[0], encode_session(data, self.encoding, indent))
+        for legacy in paths[1:]:
+            if legacy.exists():
+                legacy.unlink()
+                logger.info(f"Migrated session {legacy.name} -> {paths[0].name}")
+
+    def _atomic_write(self, path: Path, payload: bytes):
+        """按 fsync 策略原子写入"""
+        atomic_write(path, payload, fsync=self.fsync == "always")
+
+    def _unlink_sync(self, path: Path) -> bool:
+        if not path.exists():
+            return False
+        path.unlink()
+        return True
+
+    def close(self):
+        """写入活动时间索引并关闭 I/O 线程池"""
+        if self._activity_dirty:
+            self._atomic_write(
+                self.directory / self.ACTIVITY_FILE,
+                encode_session(self._activity)
+            )
+            self._activity_dirty = False
+        self._executor.shutdown(wait=True)
+
+
+def migrate_flat_layout(directory: Path) -> int:
+    """
+    把扁平布局的会话文件移动到分片目录，并按文件修改时间建立活动时间索引
+
+    Returns:
+        移动的文件数
+    """
+    activity_path = directory / SessionStore.ACTIVITY_FILE
+    activity = json.loads(activity_path.read_text(encoding="utf-8")) if activity_path.exists() else {}
+    moved = 0
+    for path in sorted(directory.iterdir()):
+        if not path.is_file() or path.name == SessionStore.ACTIVITY_FILE:
+            continue
+        chat_part = path.name.split(".")[0]
+        try:
+            chat_id = int(chat_part)
+        except ValueError:
+            continue
+        target = directory / SessionStore.shard(chat_id) / path.name
+        target.parent.mkdir(exist_ok=True)
+        if not path.name.endswith(".pending.json"):
+            activity.setdefault(str(chat_id), path.stat().st_mtime)
+        os.replace(path, target)
+        moved += 1
+    activity_path.write_text(json.dumps(activity), encoding="utf-8")
+    return moved
+
+
+def main():
+    """命令行入口：会话目录维护"""
+    parser = argparse.ArgumentParser(description="MiniClaw 会话目录维护")
+    sub = parser.add_subparsers(dest="command", required=True)
+    migrate = sub.add_parser("migrate", help="把扁平布局迁移到分片布局")
+    migrate.add_argument("--dir", type=Path, default=Path(__file__).parent / "sessions", help="会话目录")
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        moved = migrate_flat_layout(args.dir)
+        logger.info(f"Migrated {moved} files in {args.dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""会话编码基准测试：比较 json / msgpack 的读写耗时和文件大小"""
+import asyncio
+import random
+import string
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from loguru import logger
+
+import session
+from session import SessionStore
+
+
+def make_history(turns: int, seed: int = 0) -> list:
+    """生成包含代码块和工具调用的合成会话历史"""
+    rng = random.Random(seed)
+    history = []
+    for i in range(turns):
+        code = "\n".join(
+            f"def func_{j}(x):\n    return x * {rng.randint(0, 999)}  # {''.join(rng.choices(string.ascii_letters, k=20))}"
+            for j in range(40)
+        )
+        history.append({"role": "user", "content": f"第 {i} 轮：请修改 main.py 并运行测试"})
+        history.append({
+            "role": "assistant",
+            "content": "",
+            "tool_calls": [{
+                "id": f"call_{i}",
+                "type": "function",
+                "function": {"name": "read_file", "arguments": '{"path": "main.py"}'}
+            }]
+        })
+        history.append({"role": "tool", "tool_call_id": f"call_{i}", "content": f"文件内容：\n{code}"})
+        history.append({"role": "assistant", "content": f"已完成修改：\n```python\n{code[:800]}\n```"})
+    return history
+
+
+async def bench(encoding: str, history: list, rounds: int) -> dict:
+    """测量单个编码的保存 / 加载耗时和文件大小"""
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SessionStore(Path(tmp), encoding=encoding)
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            await store.save_history(1, history)
+        save_ms = (time.perf_counter() - start) / rounds * 1000
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            await store.load_history(1)
+        load_ms = (time.perf_counter() - start) / rounds * 1000
+
+        size = store.history_path(1).stat().st_size
+        store.close()
+    return {"save_ms": save_ms, "load_ms": load_ms, "size": size}
+
+
+async def main():
+    logger.remove()
+    encodings = ["json"] + (["msgpack"] if session.msgpack else [])
+    if not session.msgpack:
+        print("⚠️ 未安装 msgpack / zstandard，仅测试 json")
+
+    print("=" * 60)
+    print("会话编码基准测试")
+    print("=" * 60)
+    for turns in (10, 100, 500):
+        history = make_history(turns)
+        print(f"\n📊 {turns} 轮（{len(history)} 条消息）")
+        for encoding in encodings:
+            r = await bench(encoding, history, rounds=5)
+            print(
+                f"  {encoding:<8} 保存 {r['save_ms']:8.2f} ms  "
+                f"加载 {r['load_ms']:8.2f} ms  大小 {r['size'] / 1024:9.1f} KB"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+"""离线测试用的替身：模拟 LLM 响应、不连接 Telegram 的 Bot"""
+import os
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable, List, Optional
+
+from session import KeyedLock, SessionStore
+from usage import UsageTracker
+
+
+def llm_response(content: Optional[str] = None, tool_calls: Optional[List[tuple]] = None):
+    """
+    构造 acompletion 响应
+
+    Args:
+        content: 文本内容
+        tool_calls: [(id, 工具名, 参数 JSON)]
+    """
+    calls = [
+        SimpleNamespace(id=call_id, function=SimpleNamespace(name=name, arguments=arguments))
+        for call_id, name, arguments in tool_calls or []
+    ] or None
+    message = SimpleNamespace(content=content, tool_calls=calls)
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=message, finish_reason="tool_calls" if calls else "stop")],
+        usage=None
+    )
+
+
+def scripted_llm(responses: list, seen: Optional[list] = None) -> Callable:
+    """按顺序返回 responses 的 Agent._call_llm 替身；seen 记录每次调用收到的 messages"""
+    queue = list(responses)
+
+    async def call_llm(model, messages, tools, usage):
+        if seen is not None:
+            seen.append([dict(m) for m in messages])
+        return queue.pop(0)
+
+    return call_llm
+
+
+def make_bot(directory: Path, agent):
+    """
+    创建不连接 Telegram 的 Bot：会话存储在 directory，使用给定的 agent
+
+    bot 模块导入时会校验 TELEGRAM_TOKEN / API_KEY，未配置 .env 时使用占位值。
+    """
+    os.environ.setdefault("TELEGRAM_TOKEN", "offline-test")
+    os.environ.setdefault("API_KEY", "offline-test")
+    from bot import TelegramBot
+
+    bot = TelegramBot.__new__(TelegramBot)
+    bot.router = None
+    bot.agent = agent
+    bot.sessions = SessionStore(directory)
+    bot.usage = UsageTracker(directory / "usage.jsonl")
+    bot.memory = None
+    bot._turns = {}
+    bot._chat_locks = KeyedLock()
+    return bot
+
+
+def fake_update(chat_id: int, text: str = "", replies: Optional[list] = None):
+    """构造 handler 使用的 Update（reply_text 记录到 replies）"""
+
+    async def reply_text(message):
+        if replies is not None:
+            replies.append(message)
+
+    return SimpleNamespace(
+        effective_chat=SimpleNamespace(id=chat_id),
+        effective_user=SimpleNamespace(id=chat_id),
+        message=SimpleNamespace(text=text, reply_text=reply_text),
+    )
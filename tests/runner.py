@@ -0,0 +1,29 @@
+"""离线测试的公共入口：依次运行模块中的 test_* 函数（也可以直接用 pytest 运行）"""
+from typing import Any, Dict
+
+
+def run_tests(title: str, namespace: Dict[str, Any]) -> bool:
+    """
+    按定义顺序运行 namespace 中的 test_* 函数
+
+    Args:
+        title: 标题
+        namespace: 测试模块的 globals()
+
+    Returns:
+        是否全部通过
+    """
+    print("=" * 60)
+    print(f"🧪 {title}")
+    print("=" * 60)
+    tests = [func for name, func in namespace.items() if name.startswith("test_") and callable(func)]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+        except AssertionError as e:
+            print(f"❌ {test.__name__} 失败: {e}")
+            failed += 1
+    print("=" * 60)
+    print("🎉 所有测试通过！" if not failed else f"❌ {failed}/{len(tests)} 个测试失败")
+    return not failed
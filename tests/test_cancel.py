@@ -0,0 +1,136 @@
+"""测试取消进行中的轮次（/cancel、/clear、shell 超时）"""
+import asyncio
+import json
+import sys
+import tempfile
+from pathlib import Path
+
+# 添加项目根目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from agent import Agent
+from tests.fakes import fake_update, llm_response, make_bot, scripted_llm
+from tests.runner import run_tests
+
+# shell 在后台启动子进程并等待它，两者的 pid 写入工作目录
+SHELL_COMMAND = "echo $$ > shell.pid; sleep 30 & echo $! > child.pid; wait"
+
+
+def is_dead(pid: int) -> bool:
+    """进程已退出（不存在或只剩僵尸进程）"""
+    try:
+        stat = Path(f"/proc/{pid}/stat").read_text()
+    except FileNotFoundError:
+        return True
+    return stat.rsplit(")", 1)[1].split()[0] == "Z"
+
+
+async def wait_for_pids(workspace: Path) -> list:
+    """等待 shell 和子进程都写入 pid"""
+    paths = [workspace / "shell.pid", workspace / "child.pid"]
+    for _ in range(100):
+        texts = [p.read_text().strip() if p.exists() else "" for p in paths]
+        if all(texts):
+            return [int(t) for t in texts]
+        await asyncio.sleep(0.05)
+    raise AssertionError("shell 命令没有启动")
+
+
+def shell_agent(workspace: Path, **kwargs) -> Agent:
+    """第一次 LLM 调用执行 SHELL_COMMAND 的 Agent"""
+    agent = Agent(model="gpt-4o-mini", workspace=workspace, **kwargs)
+    agent._call_llm = scripted_llm([
+        llm_response(tool_calls=[("c1", "exec_shell", json.dumps({"command": SHELL_COMMAND}))]),
+        llm_response("完成"),
+    ])
+    return agent
+
+
+def test_cancel_kills_process_group():
+    """取消 shell 命令时终止整个进程组（包括后台子进程）"""
+    with tempfile.TemporaryDirectory() as tmp:
+        workspace = Path(tmp)
+        agent = Agent(model="gpt-4o-mini", workspace=workspace)
+
+        async def scenario():
+            task = asyncio.create_task(agent._exec_shell(SHELL_COMMAND))
+            pids = await wait_for_pids(workspace)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            return pids
+
+        pids = asyncio.run(scenario())
+        assert all(is_dead(pid) for pid in pids), f"进程应全部终止: {pids}"
+    print("✅ 取消时终止进程组")
+
+
+def test_timeout_kills_process_group():
+    """shell 命令超时时终止整个进程组"""
+    with tempfile.TemporaryDirectory() as tmp:
+        workspace = Path(tmp)
+        agent = Agent(model="gpt-4o-mini", workspace=workspace, shell_timeout=1)
+        result = asyncio.run(agent._exec_shell(SHELL_COMMAND))
+        pids = [int((workspace / name).read_text()) for name in ("shell.pid", "child.pid")]
+        assert "超时" in result, f"应返回超时提示: {result}"
+        assert all(is_dead(pid) for pid in pids), f"进程应全部终止: {pids}"
+    print("✅ 超时时终止进程组")
+
+
+def test_cancel_turn():
+    """/cancel 取消轮次：终止 shell 命令，历史记录为已取消，不留下检查点"""
+    with tempfile.TemporaryDirectory() as tmp:
+        workspace = Path(tmp)
+        bot = make_bot(workspace / "sessions", shell_agent(workspace))
+
+        async def scenario():
+            turn = asyncio.create_task(bot._execute_turn(1, "运行命令"))
+            pids = await wait_for_pids(workspace)
+            await bot.handle_cancel(fake_update(1, "/cancel"), None)
+            response = await turn
+            pending = await bot.sessions.pending_chat_ids()
+            history = await bot.sessions.load_history(1)
+            bot.sessions.close()
+            return response, pids, pending, history
+
+        response, pids, pending, history = asyncio.run(scenario())
+        assert response is None, f"被取消的轮次应返回 None: {response}"
+        assert all(is_dead(pid) for pid in pids), f"进程应全部终止: {pids}"
+        assert pending == [], "取消的轮次不应留下检查点"
+        assert history == [{"role": "user", "content": "运行命令"},
+                           {"role": "assistant", "content": "（任务已取消）"}], f"历史不正确: {history}"
+    print("✅ /cancel 取消轮次")
+
+
+def test_clear_during_turn():
+    """轮次进行中执行 /clear：先取消轮次，被取消的轮次不会把旧历史写回"""
+    with tempfile.TemporaryDirectory() as tmp:
+        workspace = Path(tmp)
+        bot = make_bot(workspace / "sessions", shell_agent(workspace))
+        replies = []
+
+        async def scenario():
+            await bot.sessions.save_history(1, [{"role": "user", "content": "旧消息"},
+                                                {"role": "assistant", "content": "旧回复"}])
+            turn = asyncio.create_task(bot._execute_turn(1, "运行命令"))
+            pids = await wait_for_pids(workspace)
+            await bot.handle_clear(fake_update(1, "/clear", replies), None)
+            response = await turn
+            pending = await bot.sessions.pending_chat_ids()
+            history = await bot.sessions.load_history(1)
+            bot.sessions.close()
+            return response, pids, pending, history
+
+        response, pids, pending, history = asyncio.run(scenario())
+        assert response is None, f"被取消的轮次应返回 None: {response}"
+        assert all(is_dead(pid) for pid in pids), f"进程应全部终止: {pids}"
+        assert replies == ["✅ 已清空对话历史"], f"回复不正确: {replies}"
+        assert pending == [] and history == [], f"历史和检查点应被清空: {history}"
+    print("✅ 轮次进行中 /clear")
+
+
+if __name__ == "__main__":
+    success = run_tests("测试取消进行中的轮次", globals())
+    exit(0 if success else 1)
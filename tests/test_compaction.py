@@ -0,0 +1,94 @@
+"""测试工具结果压缩（不调用 LLM）"""
+import sys
+from pathlib import Path
+
+# 添加项目根目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from agent import Agent
+from tests.runner import run_tests
+
+
+def make_agent(**kwargs) -> Agent:
+    """创建只用于测试压缩逻辑的 Agent（不会调用 LLM）"""
+    return Agent(model="gpt-4o-mini", workspace=Path(__file__).parent, **kwargs)
+
+
+def tool_call(call_id: str) -> dict:
+    return {
+        "role": "assistant",
+        "content": None,
+        "tool_calls": [{"id": call_id, "type": "function", "function": {"name": "read_file", "arguments": "{}"}}],
+    }
+
+
+def tool_result(call_id: str, content: str) -> dict:
+    return {"role": "tool", "tool_call_id": call_id, "content": content}
+
+
+def build_messages(count: int, size: int) -> list:
+    messages = [{"role": "system", "content": "system"}, {"role": "user", "content": "读取文件"}]
+    for n in range(count):
+        messages += [tool_call(f"c{n}"), tool_result(f"c{n}", f"{n}" * size)]
+    return messages
+
+
+def test_under_limit_unchanged():
+    """未超过上下文上限时不压缩"""
+    agent = make_agent(context_token_limit=10000)
+    messages = build_messages(3, 1000)
+    before = [m["content"] for m in messages]
+    agent._compact_tool_results(messages)
+    assert [m["content"] for m in messages] == before, "未超限时不应修改消息"
+    print("✅ 未超限时保持不变")
+
+
+def test_compacts_older_results():
+    """超限时压缩较早的结果，保留最近的结果，且不修改原消息对象"""
+    agent = make_agent(context_token_limit=500, keep_recent_tool_results=2, compacted_result_length=50)
+    messages = build_messages(5, 1000)
+    originals = list(messages)
+    agent._compact_tool_results(messages)
+
+    results = [m for m in messages if m["role"] == "tool"]
+    assert all(m["content"].startswith("[已压缩]") for m in results[:3]), "较早的结果应被压缩"
+    assert all(not m["content"].startswith("[已压缩]") for m in results[-2:]), "最近的结果应保留"
+    assert all(len(m["content"]) < 200 for m in results[:3]), "压缩后应只保留开头"
+    assert all(not m["content"].startswith("[已压缩]") for m in originals if m["role"] == "tool"), \
+        "原消息对象不应被修改"
+    print("✅ 较早的工具结果被压缩，最近的保留")
+
+
+def test_stops_when_under_limit():
+    """压缩到不超限即停止，最早的结果最先被压缩"""
+    agent = make_agent(context_token_limit=900, keep_recent_tool_results=0, compacted_result_length=50)
+    messages = build_messages(5, 1000)
+    agent._compact_tool_results(messages)
+
+    compacted = [m["content"].startswith("[已压缩]") for m in messages if m["role"] == "tool"]
+    assert compacted == [True, True, False, False, False], f"压缩顺序不正确: {compacted}"
+    print("✅ 按从旧到新压缩，回到上限内即停止")
+
+
+def test_dedup_reference_target_kept():
+    """被去重引用指向的结果不会被压缩，引用本身不占用最近窗口"""
+    agent = make_agent(context_token_limit=300, keep_recent_tool_results=1, compacted_result_length=50)
+    content = "x" * 1000
+    messages = [{"role": "system", "content": "system"}, {"role": "user", "content": "读取两次"}]
+    messages += [tool_call("c1"), tool_result("c1", content)]
+    messages += [tool_call("c2"), tool_result("c2", agent._dedup_tool_result(messages, content))]
+    messages += [tool_call("c3"), tool_result("c3", "y" * 1000)]
+    messages += [tool_call("c4"), tool_result("c4", "z" * 1000)]
+    agent._compact_tool_results(messages)
+
+    by_id = {m["tool_call_id"]: m["content"] for m in messages if m["role"] == "tool"}
+    assert by_id["c1"] == content, "被引用的结果应保持完整"
+    assert by_id["c2"].startswith("（内容与之前的工具结果 c1 相同"), "第二次读取应为引用"
+    assert by_id["c3"].startswith("[已压缩]"), "未被引用的较早结果应被压缩"
+    assert by_id["c4"] == "z" * 1000, "最近的结果应保留"
+    print("✅ 去重引用的目标不会被压缩")
+
+
+if __name__ == "__main__":
+    success = run_tests("测试工具结果压缩", globals())
+    exit(0 if success else 1)
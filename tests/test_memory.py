@@ -0,0 +1,102 @@
+"""测试检索记忆（MemoryIndex）"""
+import json
+import sys
+import tempfile
+from pathlib import Path
+
+# 添加项目根目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from memory import MemoryIndex, np, split_turns
+from tests.runner import run_tests
+
+TOPICS = ["python decorators", "banana bread recipe", "tokyo travel plan", "weather today", "git rebase"]
+
+
+def build_history(topics: list) -> list:
+    """每个主题一轮：用户消息 + 工具调用 + 最终回复"""
+    history = []
+    for topic in topics:
+        history += [
+            {"role": "user", "content": topic},
+            {"role": "assistant", "content": None, "tool_calls": [{"id": topic, "type": "function"}]},
+            {"role": "tool", "tool_call_id": topic, "content": "工具输出"},
+            {"role": "assistant", "content": f"about {topic}"},
+        ]
+    return history
+
+
+def test_select_history():
+    """最近的轮次完整保留，较早的轮次只注入最相关的精简形式"""
+    with tempfile.TemporaryDirectory() as tmp:
+        index = MemoryIndex(Path(tmp), top_k=1, recent_turns=2)
+        history = build_history(TOPICS)
+        index.update(1, history)
+        selected = index.select_history(1, history, "how do I bake bread")
+
+        recent_start = split_turns(history)[-2][0]
+        assert selected[:2] == [history[4], {"role": "assistant", "content": "about banana bread recipe"}], \
+            f"应检索到相关轮次的精简形式: {selected[:2]}"
+        assert selected[2:] == history[recent_start:], "最近的轮次应完整保留"
+    print("✅ 检索相关轮次 + 保留最近轮次")
+
+
+def test_short_history_unchanged():
+    """轮次不多于 recent_turns 时原样返回"""
+    with tempfile.TemporaryDirectory() as tmp:
+        index = MemoryIndex(Path(tmp), recent_turns=3)
+        history = build_history(TOPICS[:3])
+        assert index.select_history(1, history, "bread") == history, "短历史应原样返回"
+    print("✅ 短历史原样返回")
+
+
+def test_lazy_index():
+    """没有索引时（如刚开启检索）在检索前补建"""
+    with tempfile.TemporaryDirectory() as tmp:
+        index = MemoryIndex(Path(tmp), top_k=1, recent_turns=1)
+        history = build_history(TOPICS)
+        selected = index.select_history(2, history, "travel to tokyo")
+        meta = json.loads(index._meta_path(2).read_text(encoding="utf-8"))
+        assert len(meta["turns"]) == len(TOPICS), "应为全部轮次建立索引"
+        assert selected[0]["content"] == "tokyo travel plan", f"应检索到相关轮次: {selected[0]}"
+    print("✅ 缺失索引时惰性补建")
+
+
+def test_truncates_after_crash():
+    """追加向量后、写 meta 前中断时，下次更新先截断多余的向量"""
+    with tempfile.TemporaryDirectory() as tmp:
+        index = MemoryIndex(Path(tmp))
+        history = build_history(TOPICS[:3])
+        index.update(3, history)
+        vec_path = index._vec_path(3)
+        with vec_path.open("ab") as f:
+            f.write(b"\0" * 4096)
+
+        index.update(3, build_history(TOPICS))
+        meta = json.loads(index._meta_path(3).read_text(encoding="utf-8"))
+        assert vec_path.stat().st_size == len(meta["turns"]) * meta["dim"] * 4, "向量应与 meta 对齐"
+        matrix = np.fromfile(vec_path, dtype=np.float32).reshape(-1, meta["dim"])
+        assert np.allclose(np.linalg.norm(matrix, axis=1), 1.0), "不应包含中断留下的空向量"
+    print("✅ 中断后向量与 meta 重新对齐")
+
+
+def test_rebuild_and_delete():
+    """历史被改写时重建索引；delete 删除索引文件"""
+    with tempfile.TemporaryDirectory() as tmp:
+        index = MemoryIndex(Path(tmp))
+        index.update(4, build_history(TOPICS))
+        index.update(4, build_history(TOPICS[:2]))
+        meta = json.loads(index._meta_path(4).read_text(encoding="utf-8"))
+        assert len(meta["turns"]) == 2, "历史变短后应重建索引"
+
+        index.delete(4)
+        assert not index._vec_path(4).exists() and not index._meta_path(4).exists(), "索引文件应被删除"
+    print("✅ 重建与删除索引")
+
+
+if __name__ == "__main__":
+    if np is None:
+        print("⏭️  未安装 numpy，跳过")
+        exit(0)
+    success = run_tests("测试检索记忆", globals())
+    exit(0 if success else 1)
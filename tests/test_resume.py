@@ -0,0 +1,132 @@
+"""测试工具调用轨迹的检查点与中断恢复（不调用 LLM）"""
+import asyncio
+import sys
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+
+# 添加项目根目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from agent import Agent
+from tests.fakes import llm_response, make_bot, scripted_llm
+from tests.runner import run_tests
+
+# 中断前已完成的一次迭代：list_dir 调用及其结果
+TRACE = [
+    {
+        "role": "assistant",
+        "content": "",
+        "tool_calls": [{"id": "c1", "type": "function", "function": {"name": "list_dir", "arguments": "{}"}}],
+    },
+    {"role": "tool", "tool_call_id": "c1", "content": "目录为空"},
+]
+
+
+def test_checkpoint_per_iteration():
+    """每完成一次工具调用迭代保存一次轨迹"""
+    with tempfile.TemporaryDirectory() as tmp:
+        agent = Agent(model="gpt-4o-mini", workspace=Path(tmp))
+        agent._call_llm = scripted_llm([
+            llm_response(tool_calls=[("c1", "list_dir", "{}")]),
+            llm_response("目录是空的"),
+        ])
+        checkpoints = []
+
+        async def checkpoint(trace):
+            checkpoints.append(trace)
+
+        response = asyncio.run(agent.process("看看目录", [], checkpoint=checkpoint))
+        assert response == "目录是空的", f"响应不正确: {response}"
+        assert len(checkpoints) == 1, f"应保存 1 次检查点: {len(checkpoints)}"
+        assert [m["role"] for m in checkpoints[0]] == ["assistant", "tool"], "检查点应包含调用和结果"
+    print("✅ 逐次迭代保存检查点")
+
+
+def test_agent_resume():
+    """恢复时把已完成的轨迹放回上下文，并跳过已完成的迭代"""
+    with tempfile.TemporaryDirectory() as tmp:
+        agent = Agent(model="gpt-4o-mini", workspace=Path(tmp), max_iterations=2)
+        seen = []
+        agent._call_llm = scripted_llm([llm_response("目录是空的")], seen)
+
+        response = asyncio.run(agent.process("看看目录", [], resume=TRACE))
+        assert response == "目录是空的", f"响应不正确: {response}"
+        assert len(seen) == 1, "只应调用一次 LLM"
+        assert seen[0][-3]["content"] == "看看目录" and seen[0][-2:] == TRACE, "上下文应以恢复的轨迹结尾"
+    print("✅ Agent 从轨迹恢复")
+
+
+def test_bot_resumes_pending_turn():
+    """重启后继续未完成的轮次，完成后写入历史并删除检查点；之后的轮次不回放工具轨迹"""
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        agent = Agent(model="gpt-4o-mini", workspace=directory)
+        seen = []
+        agent._call_llm = scripted_llm([llm_response("目录是空的"), llm_response("不客气")], seen)
+        bot = make_bot(directory, agent)
+        sent = []
+
+        async def send_message(chat_id, text):
+            sent.append(text)
+
+        async def scenario():
+            await bot.sessions.save_pending(1, "看看目录", TRACE)
+            tasks = []
+            app = SimpleNamespace(
+                bot=SimpleNamespace(send_message=send_message),
+                create_task=lambda coro: tasks.append(asyncio.create_task(coro)),
+            )
+            await bot._resume_pending(app)
+            await asyncio.gather(*tasks)
+            pending = await bot.sessions.pending_chat_ids()
+            history = await bot.sessions.load_history(1)
+            await bot._execute_turn(1, "谢谢")
+            bot.sessions.close()
+            return pending, history
+
+        pending, history = asyncio.run(scenario())
+        assert sent[-1] == "目录是空的", f"应发送恢复后的响应: {sent}"
+        assert seen[0][-2:] == TRACE, "应从检查点的轨迹继续"
+        assert pending == [], "完成后应删除检查点"
+        assert history == [{"role": "user", "content": "看看目录"}, *TRACE,
+                           {"role": "assistant", "content": "目录是空的"}], "历史应包含完整轨迹"
+        assert all(m["role"] != "tool" for m in seen[1]), "之后的轮次不应回放工具轨迹"
+    print("✅ Bot 重启后恢复未完成的轮次")
+
+
+def test_late_cancel_keeps_response():
+    """保存历史期间收到的取消不会丢弃已生成的响应或留下检查点"""
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        agent = Agent(model="gpt-4o-mini", workspace=directory)
+        agent._call_llm = scripted_llm([llm_response("答案")])
+        bot = make_bot(directory, agent)
+        save_history = bot.sessions.save_history
+
+        async def slow_save(chat_id, history):
+            await asyncio.sleep(0.2)
+            await save_history(chat_id, history)
+
+        bot.sessions.save_history = slow_save
+
+        async def scenario():
+            turn = asyncio.create_task(bot._execute_turn(1, "问题"))
+            await asyncio.sleep(0.1)
+            bot._cancel_turn(1)
+            response = await turn
+            pending = await bot.sessions.pending_chat_ids()
+            history = await bot.sessions.load_history(1)
+            bot.sessions.close()
+            return response, pending, history
+
+        response, pending, history = asyncio.run(scenario())
+        assert response == "答案", f"应返回已生成的响应: {response}"
+        assert pending == [], "不应留下检查点"
+        assert history[-1] == {"role": "assistant", "content": "答案"}, "历史应已保存"
+    print("✅ 晚到的取消不丢弃响应")
+
+
+if __name__ == "__main__":
+    success = run_tests("测试检查点与中断恢复", globals())
+    exit(0 if success else 1)
@@ -0,0 +1,65 @@
+"""测试快慢模型路由（ModelRouter）"""
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+# 添加项目根目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from router import ModelRouter
+from tests.runner import run_tests
+
+
+def test_is_simple():
+    """简单消息走快速模型；涉及工具的消息不算简单"""
+    router = ModelRouter("fast", "strong")
+    simple = ["你好", "I already ate", "what is 1/2?", "and/or", "thanks, that's all"]
+    complex_ = ["帮我读取文件", "read main.py", "please run ls", "look at ./src", "```print(1)```", "x" * 300]
+    wrong = [m for m in simple if not router.is_simple(m)] + [m for m in complex_ if router.is_simple(m)]
+    assert not wrong, f"判断错误: {wrong}"
+    print("✅ 简单消息判断")
+
+
+def test_select():
+    """只有简单消息的第一轮使用快速模型"""
+    router = ModelRouter("fast", "strong")
+    assert router.select("你好", 1) == "fast", "简单消息第一轮应使用快速模型"
+    assert router.select("你好", 2) == "strong", "后续迭代应使用强模型"
+    assert router.select("run the tests", 1) == "strong", "需要工具的消息应使用强模型"
+    print("✅ 模型选择")
+
+
+def test_should_escalate():
+    """快速模型空响应、被截断或发起工具调用时升级"""
+    router = ModelRouter("fast", "strong")
+    ok = SimpleNamespace(content="好的", tool_calls=None)
+    assert not router.should_escalate("fast", ok, "stop"), "正常响应不应升级"
+    assert router.should_escalate("fast", SimpleNamespace(content="", tool_calls=None), "stop"), "空响应应升级"
+    assert router.should_escalate("fast", ok, "length"), "被截断应升级"
+    assert router.should_escalate("fast", SimpleNamespace(content=None, tool_calls=[1]), "tool_calls"), \
+        "工具调用应升级"
+    assert not router.should_escalate("strong", SimpleNamespace(content="", tool_calls=None), "stop"), \
+        "强模型不应升级"
+    print("✅ 低置信度升级")
+
+
+def test_slow_fast_model_explored():
+    """快速模型更慢时改用强模型，但定期试探，统计可以恢复"""
+    router = ModelRouter("fast", "strong", min_samples=2, explore_every=5)
+    for _ in range(2):
+        router.record("fast", 5.0)
+        router.record("strong", 1.0)
+
+    picks = [router.select("你好", 1) for _ in range(10)]
+    assert picks.count("fast") == 2, f"每 5 次应试探一次快速模型: {picks}"
+
+    # 试探时快速模型变快，统计逐渐恢复
+    for _ in range(20):
+        router.record("fast", 0.1)
+    assert router.select("你好", 1) == "fast", "快速模型恢复后应重新使用"
+    print("✅ 快速模型试探与恢复")
+
+
+if __name__ == "__main__":
+    success = run_tests("测试模型路由", globals())
+    exit(0 if success else 1)
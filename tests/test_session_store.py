@@ -0,0 +1,241 @@
+"""测试会话存储（SessionStore）：原子写入、编码迁移、分片与归档"""
+import asyncio
+import json
+import sys
+import tempfile
+from pathlib import Path
+
+# 添加项目根目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from session import KeyedLock, SessionStore, migrate_flat_layout, msgpack
+from tests.runner import run_tests
+
+HISTORY = [
+    {"role": "user", "content": "你好"},
+    {"role": "assistant", "content": "你好！有什么可以帮你？"},
+]
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_atomic_write():
+    """保存到分片目录，不留下临时文件"""
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+
+        async def scenario():
+            store = SessionStore(directory)
+            await store.save_history(42, HISTORY)
+            loaded = await store.load_history(42)
+            store.close()
+            return store.history_path(42), loaded
+
+        path, loaded = run(scenario())
+        assert path.parent.name == SessionStore.shard(42), "历史应保存在分片目录中"
+        assert path.exists() and loaded == HISTORY, "保存后应能原样读回"
+        assert not list(directory.rglob("*.tmp")), "不应留下临时文件"
+    print("✅ 原子写入到分片目录")
+
+
+def test_lazy_migration():
+    """切换编码后，读取旧格式、下次保存时改写为新格式"""
+    if msgpack is None:
+        print("⏭️  未安装 msgpack / zstandard，跳过编码迁移测试")
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+
+        async def scenario():
+            store = SessionStore(directory, encoding="json")
+            await store.save_history(7, HISTORY)
+            store.close()
+            json_path = store.history_path(7)
+
+            store = SessionStore(directory, encoding="msgpack")
+            loaded = await store.load_history(7)
+            await store.save_history(7, loaded + HISTORY)
+            reloaded = await store.load_history(7)
+            store.close()
+            return json_path, store.history_path(7), loaded, reloaded
+
+        json_path, msgpack_path, loaded, reloaded = run(scenario())
+        assert loaded == HISTORY, "应能读取旧的 json 文件"
+        assert msgpack_path.exists() and not json_path.exists(), "保存后应只保留新编码文件"
+        assert reloaded == HISTORY * 2, "新编码文件内容应正确"
+    print("✅ json → msgpack 惰性迁移")
+
+
+def test_flat_layout_fallback():
+    """读取旧的扁平布局文件（历史和检查点），保存 / 清除后不再残留"""
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        (directory / "5.json").write_text(json.dumps(HISTORY), encoding="utf-8")
+        (directory / "5.pending.json").write_text(
+            json.dumps({"user_message": "继续", "trace": []}), encoding="utf-8"
+        )
+
+        async def scenario():
+            store = SessionStore(directory)
+            pending_ids = await store.pending_chat_ids()
+            pending = await store.load_pending(5)
+            await store.clear_pending(5)
+            loaded = await store.load_history(5)
+            await store.save_history(5, loaded)
+            store.close()
+            return store, pending_ids, pending, loaded
+
+        store, pending_ids, pending, loaded = run(scenario())
+        assert pending_ids == [5] and pending["user_message"] == "继续", "应能读取扁平布局的检查点"
+        assert not (directory / "5.pending.json").exists(), "清除检查点应删除扁平布局文件"
+        assert loaded == HISTORY, "应能读取扁平布局的历史"
+        assert store.history_path(5).exists() and not (directory / "5.json").exists(), \
+            "保存后应移动到分片目录"
+    print("✅ 扁平布局回退读取")
+
+
+def test_archive_and_restore():
+    """闲置会话归档为 gzip，读取时透明恢复，再次保存后回到在用目录"""
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+
+        async def scenario():
+            store = SessionStore(directory)
+            await store.save_history(9, HISTORY)
+            await store.save_pending(10, "进行中", [])
+            await store.save_history(10, HISTORY)
+            # 模拟两个会话都已闲置
+            store._activity["9"] = store._activity["10"] = 0
+            archived = await store.archive_idle(ttl=60)
+            in_use = store.history_path(9).exists()
+            loaded = await store.load_history(9)
+            await store.save_history(9, loaded)
+            store.close()
+            return store, archived, in_use, loaded
+
+        store, archived, in_use, loaded = run(scenario())
+        archive_files = list((directory / SessionStore.ARCHIVE_DIR).rglob("9.*.gz"))
+        assert archived == [9], f"应只归档没有检查点的会话: {archived}"
+        assert not in_use, "归档后在用文件应被删除"
+        assert loaded == HISTORY, "应能从归档中读取"
+        assert store.history_path(9).exists() and not archive_files, "再次保存后应移出归档"
+        assert store.history_path(10).exists(), "有未完成轮次的会话不应归档"
+    print("✅ 闲置会话归档与恢复")
+
+
+def test_archive_skips_reactivated():
+    """扫描期间重新活跃的会话不会被归档"""
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+
+        async def scenario():
+            store = SessionStore(directory)
+            await store.save_history(11, HISTORY)
+            await store.save_history(12, HISTORY)
+            store._activity["11"] = store._activity["12"] = 0
+
+            # 归档 11 时，12 收到新消息
+            archive_sync = store._archive_sync
+
+            def archive_and_touch(chat_id):
+                if chat_id == 11:
+                    store._touch(12)
+                return archive_sync(chat_id)
+
+            store._archive_sync = archive_and_touch
+            archived = await store.archive_idle(ttl=60)
+            store.close()
+            return store, archived
+
+        store, archived = run(scenario())
+        assert archived == [11], f"重新活跃的会话不应归档: {archived}"
+        assert store.history_path(12).exists() and "12" in store._activity, "活跃会话的文件和活动时间应保留"
+    print("✅ 扫描期间重新活跃的会话不归档")
+
+
+def test_locks_evicted():
+    """文件锁在无人使用后被移除，不随会话数增长"""
+    with tempfile.TemporaryDirectory() as tmp:
+
+        async def scenario():
+            store = SessionStore(Path(tmp))
+            for chat_id in range(20):
+                await store.save_history(chat_id, HISTORY)
+                await store.delete_history(chat_id)
+            store.close()
+            return len(store._locks)
+
+        assert run(scenario()) == 0, "空闲的锁应被移除"
+
+    async def contended():
+        locks, order = KeyedLock(), []
+
+        async def worker(n):
+            async with locks["chat"]:
+                order.append(n)
+                await asyncio.sleep(0.01)
+                order.append(n)
+
+        await asyncio.gather(*(worker(n) for n in range(3)))
+        return order, len(locks)
+
+    order, remaining = run(contended())
+    assert order == [0, 0, 1, 1, 2, 2], f"同一键应串行执行: {order}"
+    assert remaining == 0, "释放后应移除锁"
+    print("✅ 空闲锁回收")
+
+
+def test_migrate_flat_layout():
+    """迁移命令把扁平文件移入分片目录并建立活动时间索引"""
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        (directory / "1.json").write_text(json.dumps(HISTORY), encoding="utf-8")
+        (directory / "2.json").write_text(json.dumps(HISTORY), encoding="utf-8")
+        (directory / "2.pending.json").write_text(json.dumps({"user_message": "x", "trace": []}), encoding="utf-8")
+        (directory / "notes.txt").write_text("不是会话文件", encoding="utf-8")
+
+        moved = migrate_flat_layout(directory)
+        activity = json.loads((directory / SessionStore.ACTIVITY_FILE).read_text(encoding="utf-8"))
+
+        assert moved == 3, f"应移动 3 个会话文件: {moved}"
+        assert (directory / SessionStore.shard(2) / "2.pending.json").exists(), "检查点应移入分片目录"
+        assert (directory / "notes.txt").exists(), "非会话文件应保持不动"
+        assert sorted(activity) == ["1", "2"], f"活动时间索引不正确: {activity}"
+
+        async def scenario():
+            store = SessionStore(directory)
+            loaded = await store.load_history(1)
+            store.close()
+            return loaded
+
+        assert run(scenario()) == HISTORY, "迁移后应能正常读取"
+    print("✅ 扁平布局迁移")
+
+
+def test_delete_history():
+    """删除历史时清理所有位置的文件"""
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        (directory / "3.json").write_text(json.dumps(HISTORY), encoding="utf-8")
+
+        async def scenario():
+            store = SessionStore(directory)
+            await store.save_history(4, HISTORY)
+            existed = await store.delete_history(3) and await store.delete_history(4)
+            missing = await store.delete_history(4)
+            remaining = await store.load_history(4)
+            store.close()
+            return existed, missing, remaining
+
+        existed, missing, remaining = run(scenario())
+        assert existed and not missing, "返回值应表示文件是否存在"
+        assert remaining == [], "删除后应读不到历史"
+        assert not list(directory.rglob("3.*")) and not list(directory.rglob("4.*")), "不应残留文件"
+    print("✅ 删除历史")
+
+
+if __name__ == "__main__":
+    success = run_tests("测试会话存储", globals())
+    exit(0 if success else 1)
@@ -0,0 +1,94 @@
+"""测试只读工具结果缓存（read_file / list_dir）"""
+import asyncio
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# 添加项目根目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from agent import Agent
+from tests.runner import run_tests
+
+
+def execute(agent: Agent, name: str, **args) -> str:
+    return asyncio.run(agent._execute_tool(name, args))
+
+
+def rewrite_keeping_stamp(path: Path, content: str):
+    """改写内容但保持 mtime 和大小不变（用于判断结果是否来自缓存）"""
+    st = path.stat()
+    path.write_text(content, encoding="utf-8")
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def test_cache_hit():
+    """mtime 和大小不变时直接返回缓存结果"""
+    with tempfile.TemporaryDirectory() as tmp:
+        agent = Agent(model="gpt-4o-mini", workspace=Path(tmp))
+        path = Path(tmp) / "a.txt"
+        path.write_text("aaaa", encoding="utf-8")
+
+        first = execute(agent, "read_file", path="a.txt")
+        rewrite_keeping_stamp(path, "bbbb")
+        assert execute(agent, "read_file", path="a.txt") == first, "应命中缓存"
+    print("✅ 缓存命中")
+
+
+def test_mtime_invalidates():
+    """文件在 Agent 之外被修改（mtime 变化）后重新读取"""
+    with tempfile.TemporaryDirectory() as tmp:
+        agent = Agent(model="gpt-4o-mini", workspace=Path(tmp))
+        path = Path(tmp) / "a.txt"
+        path.write_text("aaaa", encoding="utf-8")
+
+        execute(agent, "read_file", path="a.txt")
+        path.write_text("bbbb", encoding="utf-8")
+        st = path.stat()
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+        assert "bbbb" in execute(agent, "read_file", path="a.txt"), "mtime 变化后应重新读取"
+    print("✅ mtime 变化时失效")
+
+
+def test_write_file_invalidates():
+    """write_file 使该文件和所在目录的缓存失效（即使 mtime 精度不足以区分）"""
+    with tempfile.TemporaryDirectory() as tmp:
+        workspace = Path(tmp)
+        agent = Agent(model="gpt-4o-mini", workspace=workspace)
+        path = workspace / "a.txt"
+        path.write_text("aaaa", encoding="utf-8")
+        execute(agent, "read_file", path="a.txt")
+        execute(agent, "list_dir")
+
+        st, dir_st = path.stat(), workspace.stat()
+        execute(agent, "write_file", path="a.txt", content="bbbb")
+        execute(agent, "write_file", path="b.txt", content="new")
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.utime(workspace, ns=(dir_st.st_atime_ns, dir_st.st_mtime_ns))
+
+        assert "bbbb" in execute(agent, "read_file", path="a.txt"), "写入后读取应得到新内容"
+        assert "b.txt" in execute(agent, "list_dir"), "写入后目录列表应包含新文件"
+    print("✅ write_file 使缓存失效")
+
+
+def test_lru_bound():
+    """缓存条目数不超过 tool_cache_size，最久未使用的先淘汰"""
+    with tempfile.TemporaryDirectory() as tmp:
+        workspace = Path(tmp)
+        agent = Agent(model="gpt-4o-mini", workspace=workspace, tool_cache_size=2)
+        for name in ("a", "b", "c"):
+            (workspace / name).write_text(name, encoding="utf-8")
+        execute(agent, "read_file", path="a")
+        execute(agent, "read_file", path="b")
+        execute(agent, "read_file", path="a")
+        execute(agent, "read_file", path="c")
+
+        cached = sorted(path.name for _, path in agent._tool_cache)
+        assert cached == ["a", "c"], f"应淘汰最久未使用的 b: {cached}"
+    print("✅ LRU 容量限制")
+
+
+if __name__ == "__main__":
+    success = run_tests("测试只读工具缓存", globals())
+    exit(0 if success else 1)
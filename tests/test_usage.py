@@ -0,0 +1,112 @@
+"""测试 token 用量统计与准入控制（UsageTracker）"""
+import json
+import sys
+import tempfile
+from pathlib import Path
+
+# 添加项目根目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from usage import GLOBAL_KEY, UsageTracker
+from tests.runner import run_tests
+
+
+def test_record_and_summary():
+    """按会话和全局累计 token 与工具耗时"""
+    with tempfile.TemporaryDirectory() as tmp:
+        tracker = UsageTracker(Path(tmp) / "usage.jsonl")
+        tracker.record(1, {"prompt_tokens": 100, "completion_tokens": 20, "tool_time": 1.5})
+        tracker.record(2, {"prompt_tokens": 50, "completion_tokens": 5, "tool_time": 0.0})
+
+        assert tracker.entries["1"]["day_tokens"] == 120, "会话用量不正确"
+        assert tracker.entries[GLOBAL_KEY]["day_tokens"] == 175, "全局用量不正确"
+        assert tracker.entries[GLOBAL_KEY]["turns"] == 2, "全局轮次不正确"
+        assert "120" in tracker.summary(1) and "175" in tracker.summary(1), "summary 应包含会话和全局用量"
+    print("✅ 用量累计")
+
+
+def test_admit_chat_quota():
+    """会话配额用完后拒绝该会话，不影响其他会话"""
+    with tempfile.TemporaryDirectory() as tmp:
+        tracker = UsageTracker(Path(tmp) / "usage.jsonl", chat_tokens_per_minute=100)
+        assert tracker.admit(1) is None, "初始应允许"
+        tracker.record(1, {"prompt_tokens": 80, "completion_tokens": 30})
+        assert tracker.admit(1) and "本会话" in tracker.admit(1), "超出会话配额应拒绝"
+        assert tracker.admit(2) is None, "其他会话不受影响"
+    print("✅ 会话配额")
+
+
+def test_admit_global_quota():
+    """全局配额用完后拒绝所有会话"""
+    with tempfile.TemporaryDirectory() as tmp:
+        tracker = UsageTracker(Path(tmp) / "usage.jsonl", global_tokens_per_day=100)
+        tracker.record(1, {"prompt_tokens": 100})
+        reason = tracker.admit(2)
+        assert reason and "全局" in reason, f"超出全局配额应拒绝: {reason}"
+    print("✅ 全局配额")
+
+
+def test_window_reset():
+    """分钟窗口过期后重置"""
+    with tempfile.TemporaryDirectory() as tmp:
+        tracker = UsageTracker(Path(tmp) / "usage.jsonl", chat_tokens_per_minute=100)
+        tracker.record(1, {"prompt_tokens": 200})
+        assert tracker.admit(1), "超出配额应拒绝"
+        # 模拟进入下一分钟
+        tracker.entries["1"]["minute"] -= 1
+        tracker.entries[GLOBAL_KEY]["minute"] -= 1
+        assert tracker.admit(1) is None, "新的分钟窗口应允许"
+        assert tracker.entries["1"]["day_tokens"] == 200, "当天用量不应被重置"
+    print("✅ 窗口重置")
+
+
+def test_save_and_load():
+    """只追加有变化的统计对象，重新加载后用量保留"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "usage.jsonl"
+        tracker = UsageTracker(path)
+        tracker.save()
+        assert not path.exists(), "无变化时不应写入"
+
+        tracker.record(1, {"prompt_tokens": 10, "completion_tokens": 5})
+        tracker.save()
+        tracker.record(2, {"prompt_tokens": 1})
+        tracker.save()
+        keys = [json.loads(line)["key"] for line in path.read_text(encoding="utf-8").splitlines()]
+        assert sorted(keys) == sorted(["1", "2", GLOBAL_KEY, GLOBAL_KEY]), f"应只追加有变化的统计对象: {keys}"
+
+        reloaded = UsageTracker(path)
+        assert reloaded.entries["1"]["completion_tokens"] == 5, "重新加载后用量应保留"
+        assert reloaded.entries[GLOBAL_KEY]["prompt_tokens"] == 11, "后写入的行应覆盖先写入的"
+    print("✅ 增量保存与加载")
+
+
+def test_log_compaction():
+    """日志过长或末尾有半行时整体重写"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "usage.jsonl"
+        tracker = UsageTracker(path)
+        tracker.COMPACT_SLACK = 0
+        for _ in range(10):
+            tracker.record(1, {"prompt_tokens": 1})
+            tracker.save()
+        lines = path.read_text(encoding="utf-8").splitlines()
+        assert len(lines) <= len(tracker.entries) * tracker.COMPACT_RATIO, f"日志应被重写: {len(lines)} 行"
+        assert not list(Path(tmp).glob("*.tmp")), "不应留下临时文件"
+
+        # 模拟写入中断留下的半行
+        with path.open("a", encoding="utf-8") as f:
+            f.write('{"key": "1", "prompt')
+        tracker = UsageTracker(path)
+        tracker.record(2, {"prompt_tokens": 1})
+        tracker.save()
+        reloaded = UsageTracker(path)
+        assert reloaded.entries["1"]["prompt_tokens"] == 10 and reloaded.entries["2"]["prompt_tokens"] == 1, \
+            "重写后用量应完整"
+        assert not reloaded._log_damaged, "重写后不应再有损坏的行"
+    print("✅ 日志重写")
+
+
+if __name__ == "__main__":
+    success = run_tests("测试 token 用量与准入控制", globals())
+    exit(0 if success else 1)
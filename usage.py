@@ -0,0 +1,185 @@
+"""Usage - token 用量统计、配额和准入控制"""
+import asyncio
+import json
+import time
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
+from loguru import logger
+
+from session import atomic_write
+
+
+GLOBAL_KEY = "global"
+
+
+def _new_entry() -> Dict[str, float]:
+    """单个统计对象：累计值 + 当前分钟 / 当天的固定窗口"""
+    return {
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "tool_time": 0.0,
+        "turns": 0,
+        "minute": 0,
+        "minute_tokens": 0,
+        "day": "",
+        "day_tokens": 0,
+    }
+
+
+class UsageTracker:
+    """
+    按会话和全局统计 token 用量
+
+    统计保存在内存中，定期把有变化的统计对象追加到 JSONL 日志（每行一个，后写的覆盖先写的），
+    日志行数远多于统计对象数时整体重写；配额按固定的分钟 / 自然日窗口计算。
+    配额为 0 表示不限制。
+    """
+
+    # 日志行数超过 统计对象数 * COMPACT_RATIO + COMPACT_SLACK 时重写
+    COMPACT_RATIO = 2
+    COMPACT_SLACK = 64
+
+    def __init__(
+        self,
+        path: Path,
+        chat_tokens_per_minute: int = 0,
+        chat_tokens_per_day: int = 0,
+        global_tokens_per_minute: int = 0,
+        global_tokens_per_day: int = 0
+    ):
+        self.path = path
+        self.limits = {
+            "chat": (chat_tokens_per_minute, chat_tokens_per_day),
+            GLOBAL_KEY: (global_tokens_per_minute, global_tokens_per_day),
+        }
+        self.entries, self._log_lines, self._log_damaged = self._load()
+        # 自上次保存以来有变化的统计对象
+        self._dirty: Set[str] = set()
+        logger.info(f"UsageTracker initialized: path={path}, limits={self.limits}")
+
+    def _load(self) -> Tuple[Dict[str, Dict[str, float]], int, bool]:
+        """
+        读取用量日志
+
+        Returns:
+            (统计对象, 日志行数, 是否有无法解析的行)
+        """
+        entries: Dict[str, Dict[str, float]] = {}
+        lines, damaged = 0, False
+        if not self.path.exists():
+            return entries, lines, damaged
+        with self.path.open(encoding="utf-8") as f:
+            for line in f:
+                lines += 1
+                try:
+                    record = json.loads(line)
+                    entries[record.pop("key")] = record
+                except (json.JSONDecodeError, KeyError, AttributeError):
+                    # 写入中断时可能留下半行
+                    damaged = True
+        if damaged:
+            logger.warning(f"Ignored damaged lines in {self.path}")
+        return entries, lines, damaged
+
+    def _entry(self, key: str) -> Dict[str, float]:
+        """获取统计对象，并在窗口过期时重置"""
+        entry = self.entries.setdefault(key, _new_entry())
+        now = time.time()
+        minute = int(now // 60)
+        day = time.strftime("%Y-%m-%d", time.localtime(now))
+        if entry["minute"] != minute:
+            entry["minute"], entry["minute_tokens"] = minute, 0
+        if entry["day"] != day:
+            entry["day"], entry["day_tokens"] = day, 0
+        return entry
+
+    def admit(self, chat_id: int) -> Optional[str]:
+        """
+        准入检查
+
+        Returns:
+            拒绝原因；允许时返回 None
+        """
+        for key, kind in ((str(chat_id), "chat"), (GLOBAL_KEY, GLOBAL_KEY)):
+            per_minute, per_day = self.limits[kind]
+            entry = self._entry(key)
+            scope = "本会话" if kind == "chat" else "全局"
+            if per_minute and entry["minute_tokens"] >= per_minute:
+                return f"{scope}每分钟 token 配额已用完（{per_minute}），请稍后再试"
+            if per_day and entry["day_tokens"] >= per_day:
+                return f"{scope}今日 token 配额已用完（{per_day}）"
+        return None
+
+    def record(self, chat_id: int, usage: Dict[str, float]):
+        """记录一轮对话的用量"""
+        tokens = usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0)
+        for key in (str(chat_id), GLOBAL_KEY):
+            entry = self._entry(key)
+            entry["prompt_tokens"] += usage.get("prompt_tokens", 0)
+            entry["completion_tokens"] += usage.get("completion_tokens", 0)
+            entry["tool_time"] += usage.get("tool_time", 0.0)
+            entry["turns"] += 1
+            entry["minute_tokens"] += tokens
+            entry["day_tokens"] += tokens
+            self._dirty.add(key)
+        logger.debug(f"Usage for {chat_id}: +{tokens} tokens, tool_time={usage.get('tool_time', 0.0):.2f}s")
+
+    def summary(self, chat_id: int) -> str:
+        """会话和全局用量（用于 /status）"""
+        lines = []
+        for key, kind, label in ((str(chat_id), "chat", "本会话"), (GLOBAL_KEY, GLOBAL_KEY, "全局")):
+            entry = self._entry(key)
+            _, per_day = self.limits[kind]
+            quota = f" / {per_day}" if per_day else ""
+            lines.append(
+                f"  - {label}: 今日 {int(entry['day_tokens'])}{quota} tokens，"
+                f"累计 {int(entry['prompt_tokens'] + entry['completion_tokens'])} tokens"
+                f"（{int(entry['turns'])} 轮，工具 {entry['tool_time']:.1f}s）"
+            )
+        return "\n".join(lines)
+
+    def _snapshot(self) -> Dict[str, Dict[str, float]]:
+        """复制有变化的统计对象并清空变化集合（只复制变化的部分，开销与活跃会话数成正比）"""
+        changes = {key: dict(self.entries[key]) for key in self._dirty}
+        self._dirty.clear()
+        return changes
+
+    def save(self):
+        """把有变化的用量写入磁盘"""
+        changes = self._snapshot()
+        if changes:
+            self._write(changes)
+
+    def _write(self, changes: Dict[str, Dict[str, float]]):
+        """追加到日志；日志过长或有损坏的行时连同已有内容整体重写"""
+        limit = len(self.entries) * self.COMPACT_RATIO + self.COMPACT_SLACK
+        if not self._log_damaged and self._log_lines + len(changes) <= limit:
+            with self.path.open("a", encoding="utf-8") as f:
+                f.write(self._serialize(changes))
+            self._log_lines += len(changes)
+            return
+
+        entries, _, _ = self._load()
+        entries.update(changes)
+        atomic_write(self.path, self._serialize(entries).encode("utf-8"))
+        self._log_lines, self._log_damaged = len(entries), False
+        logger.debug(f"Compacted usage log: {len(entries)} entries")
+
+    @staticmethod
+    def _serialize(entries: Dict[str, Dict[str, float]]) -> str:
+        return "".join(json.dumps({"key": key, **entry}, ensure_ascii=False) + "\n" for key, entry in entries.items())
+
+    async def run_flush(self, interval: float = 60):
+        """后台任务：定期保存有变化的用量"""
+        while True:
+            await asyncio.sleep(interval)
+            # 在事件循环中复制，避免与 record 并发修改；序列化和写入在线程中执行
+            changes = self._snapshot()
+            if not changes:
+                continue
+            try:
+                await asyncio.to_thread(self._write, changes)
+            except Exception as e:
+                logger.error(f"Failed to save usage: {e}")
+                # 下次重试
+                self._dirty.update(changes)